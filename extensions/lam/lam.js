@@ -3,7 +3,7 @@ import { waitImage } from "../../js/image-utils.js";
 import Viewer from "../../js/viewer.js";
 
 export default class LAM {
-    static patch(entrypoint = `http://localhost:5000/lam`) {
+    static patch(entrypoint = `http://localhost:5000/lam`, pollInterval = 500) {
         const zipImages = ['image_abs.png', 'blend_abs.png', 'blend_kde.png', 'tensor.png'];
         let index = 1;
         const getContainers = (viewer) => {
@@ -19,7 +19,19 @@ export default class LAM {
             return image;
         }
 
+        let currentJob = null;
+        // Bumped on every entry to and exit from LAM mode, so a request answered after the user left it is dropped.
+        let lamRun = 0;
+        const cancelJob = () => {
+            if (currentJob) {
+                fetch(`${entrypoint}/jobs/${currentJob}`, { method: 'DELETE' }).catch(console.error);
+                currentJob = null;
+            }
+        }
+
         const exitLAMMode = (viewer) => {
+            lamRun++;
+            cancelJob();
             for (const container of viewer.imageContainers) {
                 container.lam = null;
                 container.infoLabel.style.backgroundColor = 'blue';
@@ -100,6 +112,8 @@ export default class LAM {
 
                     if (this.zoomMode) {
                         this.lamMode = true;
+                        const run = ++lamRun;
+                        const active = () => run === lamRun;
                         const minSize = Math.min(this.zoomAreaWidth, this.zoomAreaHeight);
                         this.zoomAreaWidth = this.zoomAreaHeight = minSize;
                         for (let i = 0; i < containers.length; i++) {
@@ -119,27 +133,96 @@ export default class LAM {
                         const positionImage = await fetch(entrypoint, {
                             method: 'POST', headers: { 'Content-Type': 'application/json' }, body,
                         }).then(r => r.blob()).then(blobToImage);
+                        if (!active()) {
+                            return;
+                        }
                         positionImage.rawImage = this.getImage(gtContainer.target, file);
                         gtContainer.lam = { image: positionImage, label: ` [GT]` };
                         await waitImage(positionImage);
+                        if (!active()) {
+                            return;
+                        }
                         await gtContainer.setImage(positionImage, this);
+                        if (!active()) {
+                            return;
+                        }
                         if (this.zoomMode) {
                             gtContainer.canvas.updateZoomInterfaceData(this.zoomDrawParams.event);
                             gtContainer.canvas.drawZoomInterface(this.zoomDrawParams);
                         }
 
+                        const paths = containers.map(({ target }) => target.model || target.path.split('/visualization').shift());
                         for (let i = 0; i < containers.length; i++) {
-                            try {
-                                containers[i].lam = { label: ` (calculating)` };
-                                const { target } = containers[i];
-                                const path = target.model || target.path.split('/visualization').shift();
-                                const body = JSON.stringify({ type: 'lam', path, file: filePath, ...location });
-                                const response = await fetch(entrypoint, {
-                                    method: 'POST', headers: { 'Content-Type': 'application/json' }, body,
-                                });
-                                containers[i].lam = { label: ` (loading)` };
-                                if (response.status === 200) {
-                                    const zip = await JSZip.loadAsync(await response.blob());
+                            containers[i].lam = { label: ` (calculating)` };
+                        }
+                        this.updateInfoLabel();
+                        try {
+                            const body = JSON.stringify({ type: 'lam_multi', paths, file: filePath, ...location });
+                            const { id } = await fetch(`${entrypoint}/jobs`, {
+                                method: 'POST', headers: { 'Content-Type': 'application/json' }, body,
+                            }).then(r => r.json());
+                            if (!active()) {
+                                fetch(`${entrypoint}/jobs/${id}`, { method: 'DELETE' }).catch(console.error);
+                                return;
+                            }
+                            currentJob = id;
+                            const painted = new Set();
+                            const previewed = {};
+                            while (currentJob === id) {
+                                const job = await fetch(`${entrypoint}/jobs/${id}`).then(r => r.json());
+                                if (currentJob !== id) {
+                                    break;
+                                }
+                                for (const [i, error] of Object.entries(job.errors)) {
+                                    if (!painted.has(i) && containers[i]) {
+                                        painted.add(i);
+                                        console.error(error);
+                                        containers[i].lam = { error, label: ` (error)` };
+                                        containers[i].infoLabel.style.backgroundColor = 'red';
+                                    }
+                                }
+                                // Show the diffusion index and the selected map of a result still rendering.
+                                for (const [i, members] of Object.entries(job.members)) {
+                                    const shown = previewed[i] ??= new Set();
+                                    if (painted.has(parseInt(i)) || !containers[i]) {
+                                        continue;
+                                    }
+                                    for (const name of ['data.json', zipImages[index]].filter(name => members.includes(name) && !shown.has(name))) {
+                                        shown.add(name);
+                                        const response = await fetch(`${entrypoint}/jobs/${id}/result/${i}/${name}`);
+                                        if (currentJob !== id || !response.ok) {
+                                            break;
+                                        }
+                                        const lam = { ...containers[i].lam };
+                                        if (name === 'data.json') {
+                                            const { diffusionIndex } = await response.json();
+                                            lam.label = `, DI: ${diffusionIndex} (rendering)`;
+                                        } else {
+                                            lam.image = blobToImage(await response.blob());
+                                            await waitImage(lam.image);
+                                            lam.image.rawImage = this.getImage(containers[i].target, file);
+                                        }
+                                        if (painted.has(parseInt(i))) {
+                                            break;
+                                        }
+                                        containers[i].lam = lam;
+                                        if (lam.image) {
+                                            await containers[i].setImage(lam.image, this);
+                                            if (this.zoomMode) {
+                                                containers[i].canvas.drawZoomInterface(this.zoomDrawParams);
+                                            }
+                                        }
+                                        this.updateInfoLabel();
+                                    }
+                                }
+                                for (const i of job.done.filter(i => !painted.has(i))) {
+                                    painted.add(i);
+                                    containers[i].lam = { ...containers[i].lam, label: ` (loading)` };
+                                    const blob = await fetch(`${entrypoint}/jobs/${id}/result/${i}`).then(r => r.blob());
+                                    if (currentJob !== id) {
+                                        break;
+                                    }
+                                    const zip = await JSZip.loadAsync(blob);
                                     const images = await Promise.all(zipImages.map(name => zip.file(name).async('blob').then(blobToImage)));
                                     const { diffusionIndex } = await zip.file('data.json').async('string').then(data => JSON.parse(data));
                                     containers[i].lam = { images, diffusionIndex, label: `, DI: ${diffusionIndex}` };
@@ -149,17 +232,30 @@ export default class LAM {
                                     if (this.zoomMode) {
                                         containers[i].canvas.drawZoomInterface(this.zoomDrawParams);
                                     }
-                                } else {
-                                    const { error } = await response.json();
-                                    console.error(error);
-                                    containers[i].lam = { error, label: ` (error)` };
-                                    containers[i].infoLabel.style.backgroundColor = 'red';
                                 }
-                            } catch (e) {
-                                containers[i].lam = { label: ` (error)` };
-                                containers[i].infoLabel.style.backgroundColor = 'red';
-                                console.error(e);
+                                if (job.status !== 'queued' && job.status !== 'running') {
+                                    if (job.errors.job) {
+                                        throw new Error(job.errors.job);
+                                    }
+                                    break;
+                                }
+                                await new Promise(resolve => setTimeout(resolve, pollInterval));
+                            }
+                            if (currentJob === id) {
+                                currentJob = null;
+                            }
+                        } catch (e) {
+                            if (!active()) {
+                                // LAM mode was left, exitLAMMode already reset the containers.
+                                return;
+                            }
+                            for (const container of containers) {
+                                if (!container.lam?.images) {
+                                    container.lam = { label: ` (error)` };
+                                    container.infoLabel.style.backgroundColor = 'red';
+                                }
                             }
+                            console.error(e);
                         }
                     }
                 }
@@ -5,28 +5,35 @@ from collections import OrderedDict
 from .carn import Net as CARN
 from .carn_m import Net as CARNM
 from ModelZoo import MODEL_DIR
+from ModelZoo.checkpoints import load_converted
 
 
 def load_carn():
     carn_model = CARN(2)
-    state_dict = torch.load(os.path.join(MODEL_DIR, 'carn.pth'), map_location=torch.device('cpu'))
-    new_state_dict = OrderedDict()
-    for k, v in state_dict.items():
-        name = k
-        # name = k[7:] # remove "module."
-        new_state_dict[name] = v
+    state_dict_path = os.path.join(MODEL_DIR, 'carn.pth')
+    def convert():
+        state_dict = torch.load(state_dict_path, map_location=torch.device('cpu'))
+        new_state_dict = OrderedDict()
+        for k, v in state_dict.items():
+            name = k
+            # name = k[7:] # remove "module."
+            new_state_dict[name] = v
 
-    carn_model.load_state_dict(new_state_dict)
-    return carn_model
+        carn_model.load_state_dict(new_state_dict)
+
+    return load_converted(carn_model, state_dict_path, convert)
 
 def load_carnm():
     carn_model = CARNM(2)
-    state_dict = torch.load(os.path.join(MODEL_DIR, 'carn_m.pth'), map_location=torch.device('cpu'))
-    new_state_dict = OrderedDict()
-    for k, v in state_dict.items():
-        name = k
-        # name = k[7:] # remove "module."
-        new_state_dict[name] = v
-
-    carn_model.load_state_dict(new_state_dict)
-    return carn_model
\ No newline at end of file
+    state_dict_path = os.path.join(MODEL_DIR, 'carn_m.pth')
+    def convert():
+        state_dict = torch.load(state_dict_path, map_location=torch.device('cpu'))
+        new_state_dict = OrderedDict()
+        for k, v in state_dict.items():
+            name = k
+            # name = k[7:] # remove "module."
+            new_state_dict[name] = v
+
+        carn_model.load_state_dict(new_state_dict)
+
+    return load_converted(carn_model, state_dict_path, convert)
\ No newline at end of file
@@ -1,5 +1,6 @@
 import os
 import torch
+from .checkpoints import load_converted
 
 MODEL_DIR = '/content/LAM_Demo/ModelZoo/models'
 
@@ -98,9 +99,7 @@ def load_model(model_loading_name):
     net = get_model(model_name)
     state_dict_path = os.path.join(MODEL_DIR, MODEL_LIST[model_name][training_name])
     print(f'Loading model {state_dict_path} for {model_name} network.')
-    state_dict = torch.load(state_dict_path, map_location='cpu')
-    net.load_state_dict(state_dict)
-    return net
+    return load_converted(net, state_dict_path, lambda: net.load_state_dict(torch.load(state_dict_path, map_location='cpu')))
 
 
 
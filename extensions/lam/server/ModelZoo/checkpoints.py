@@ -0,0 +1,82 @@
+import os
+import json
+import hashlib
+import itertools
+import threading
+import torch
+from os import path as osp
+from cache import DiskLRU
+
+CHECKPOINT_CACHE_DIR = os.environ.get('LAM_CHECKPOINT_CACHE_DIR', osp.expanduser('~/.cache/lam/checkpoints'))
+CHECKPOINT_CACHE_BYTES = int(os.environ.get('LAM_CHECKPOINT_CACHE_BYTES', 16 * 1024 ** 3))
+checkpoint_disks = {}
+checkpoint_disks_lock = threading.Lock()
+
+
+def checkpoint_disk(cache_dir):
+    """
+    DiskLRU of a directory of converted checkpoints, bounded by CHECKPOINT_CACHE_BYTES, as every new mtime or set of
+    load arguments of a checkpoint writes another copy.
+    """
+    with checkpoint_disks_lock:
+        if cache_dir not in checkpoint_disks:
+            checkpoint_disks[cache_dir] = DiskLRU(cache_dir, CHECKPOINT_CACHE_BYTES)
+        return checkpoint_disks[cache_dir]
+
+
+def converted_checkpoint_path(net, checkpoint_path, cache_dir=CHECKPOINT_CACHE_DIR, identity=None):
+    """
+    Cache file of the converted checkpoint_path for net, changing with the checkpoint file, the network layout and identity.
+    :param identity: JSON-serializable arguments of the conversion, e.g. which weights of the checkpoint it reads
+    """
+    stat = os.stat(checkpoint_path)
+    identity = {
+        'checkpoint': [osp.realpath(checkpoint_path), stat.st_size, stat.st_mtime_ns],
+        'net': f'{type(net).__module__}.{type(net).__qualname__}',
+        'layout': [[name, list(tensor.shape), str(tensor.dtype)] for name, tensor in net.state_dict().items()],
+        'identity': identity,
+    }
+    digest = hashlib.sha256(json.dumps(identity).encode('utf-8')).hexdigest()
+    return osp.join(cache_dir, f'{digest[:32]}.pt')
+
+
+def convert_tensor(tensor):
+    # Conv weights are stored channels_last, as CPU inference uses them, so moving the model to that format keeps the mapping.
+    if tensor.dim() == 4 and tensor.is_floating_point():
+        return torch.empty_like(tensor, device='cpu', memory_format=torch.channels_last).copy_(tensor)
+    return tensor.detach().cpu().contiguous()
+
+
+def load_converted(net, checkpoint_path, convert, cache_dir=CHECKPOINT_CACHE_DIR, identity=None):
+    """
+    Load the weights of checkpoint_path into net through a converted copy of its state dict, memory-mapped on every load.
+    The first load calls convert() to fill net the usual way, key remapping included, and saves net.state_dict().
+    Processes mapping the same file share one physical copy of the weights; cold loads become page faults.
+    :param convert: callable loading checkpoint_path into net
+    :param cache_dir: directory of the converted checkpoints, None to only call convert().
+        Least recently loaded copies are deleted past LAM_CHECKPOINT_CACHE_BYTES.
+    :param identity: arguments of convert() besides checkpoint_path, see converted_checkpoint_path
+    :return: net
+    """
+    if cache_dir is None:
+        convert()
+        return net
+    target = converted_checkpoint_path(net, checkpoint_path, cache_dir, identity)
+    disk = checkpoint_disk(cache_dir)
+    written = not osp.exists(target)
+    if written:
+        convert()
+        temp = f'{target}.{os.getpid()}.tmp'
+        torch.save({name: convert_tensor(tensor) for name, tensor in net.state_dict().items()}, temp)
+        os.replace(temp, target)
+    state_dict = torch.load(target, map_location='cpu', mmap=True, weights_only=True)
+    # Evicting only unlinks the files under an open map, so the new copy is accounted once it is mapped.
+    if written:
+        disk.add(target)
+    else:
+        disk.touch(target)
+    # Assigning the mapped tensors only makes sense while the network lives on the CPU.
+    on_cpu = all(tensor.device.type == 'cpu' for tensor in itertools.chain(net.parameters(), net.buffers()))
+    # nn.Module's own loader, as networks like RCAN override load_state_dict without assign.
+    torch.nn.Module.load_state_dict(net, state_dict, strict=True, assign=on_cpu)
+    return net
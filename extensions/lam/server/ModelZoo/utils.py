@@ -1,7 +1,13 @@
 import os
+import math
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from PIL import Image
 import torchvision
 import torch
+from torch.nn.modules.utils import _pair
+from torch.utils.checkpoint import checkpoint
 
 
 IMG_EXTENSIONS = ['jpg', 'jpeg', 'png', 'ppm', 'bmp', 'pgm']
@@ -24,16 +30,146 @@ def pil_loader(path, mode='RGB'):
             return img.convert(mode)
 
 
-def calculate_RF(model):
-    layers = getLayers(model)
+def calculate_RF(model, num_channels=3, probe_size=32):
+    """
+    Theoretical receptive field of model, in input pixels.
+    The model runs once on a probe input, and every convolution and pooling layer that executes adds
+    its dilated kernel extent times its input stride, so upsamplers (also functional interpolation),
+    strides, dilations and unused branches are accounted for. Global pooling is ignored.
+    :param model: the given model
+    :param num_channels: input channels of the model
+    :param probe_size: spatial size of the probe input
+    :return: receptive field width
+    """
+    records = []
+    def record(module, inputs, output):
+        records.append((module, inputs[0].shape[-1]))
+
+    layers = [layer for layer in getLayers(model) if isinstance(layer, (torch.nn.Conv2d, torch.nn.MaxPool2d, torch.nn.AvgPool2d))]
+    handles = [layer.register_forward_hook(record) for layer in layers]
+    try:
+        parameter = next(model.parameters())
+        with torch.inference_mode():
+            model(torch.zeros(1, num_channels, probe_size, probe_size, device=parameter.device, dtype=parameter.dtype))
+    finally:
+        for handle in handles:
+            handle.remove()
+
     r = 1
-    for layer in layers[::-1]:
-        if isinstance(layer, torch.nn.Conv2d):
-            kernel = layer.kernel_size[0]
-            padding = layer.padding[0]
-            stride = layer.stride[0]
-            r = stride * r + (kernel - stride)
-    return r
+    for layer, input_width in records:
+        kernel = _pair(layer.kernel_size)[1]
+        dilation = _pair(getattr(layer, 'dilation', 1))[1]
+        r += dilation * (kernel - 1) * probe_size / input_width
+    return math.ceil(r)
+
+
+def calculate_ERF(model, tolerance=1e-3, num_channels=3, max_probe_size=256, seed=0):
+    """
+    Effective receptive field radius of model, in input pixels: the half-width of the smallest square
+    around an input position that holds 1 - tolerance of the input gradient magnitude of the output
+    pixel above it, measured on a random probe no larger than max_probe_size.
+    :return: radius, at most calculate_RF(model) // 2
+    """
+    rf_radius = calculate_RF(model, num_channels) // 2
+    size = min(2 * rf_radius + 8, max_probe_size) // 8 * 8
+    parameter = next(model.parameters())
+    generator = torch.Generator().manual_seed(seed)
+    probe = torch.rand(1, num_channels, size, size, generator=generator).to(parameter)
+    probe.requires_grad_(True)
+    output = model(probe)
+    scale = output.shape[-1] // size
+    center = size // 2
+    target = output[:, :, center * scale, center * scale].sum()
+    grad, = torch.autograd.grad(target, probe)
+    mass = grad.abs().sum(dim=(0, 1)).flatten().cpu()
+
+    ys, xs = torch.meshgrid(torch.arange(size), torch.arange(size), indexing='ij')
+    distance = torch.maximum((ys - center).abs(), (xs - center).abs()).flatten()
+    cumulative = torch.zeros(size, dtype=mass.dtype).index_add_(0, distance, mass).cumsum(0)
+    radius = int(torch.searchsorted(cumulative, (1 - tolerance) * cumulative[-1]))
+    return min(radius, rf_radius)
+
+
+# Repeated body blocks of RRDBNet, RCAN and SAN, matched by class name so BasicSR's copies of the architectures match too
+CHECKPOINT_BLOCKS = ('RRDB', 'ResidualGroup', 'LSRAG')
+checkpointing_lock = threading.Lock()
+checkpointed_models = {}
+
+
+class CheckpointSegment(torch.nn.Module):
+    """
+    Consecutive blocks run as one recomputation checkpoint: backward keeps only the segment input and reruns the blocks.
+    """
+
+    def __init__(self, blocks):
+        super(CheckpointSegment, self).__init__()
+        self.blocks = torch.nn.ModuleList(blocks)
+
+    def run(self, x):
+        for block in self.blocks:
+            x = block(x)
+        return x
+
+    def forward(self, x):
+        if not torch.is_grad_enabled():
+            return self.run(x)
+        return checkpoint(self.run, x, use_reentrant=False)
+
+
+def checkpoint_children(container, every, block_names):
+    children = OrderedDict()
+    run = []
+    for name, child in list(container._modules.items()) + [(None, None)]:
+        if child is not None and type(child).__name__ in block_names:
+            run.append((name, child))
+            # A ModuleList is called block by block from its parent's forward, so its blocks can only be segments of one.
+            if len(run) == every or isinstance(container, torch.nn.ModuleList):
+                children[run[0][0]] = CheckpointSegment([block for _, block in run])
+                run = []
+            continue
+        if run:
+            children[run[0][0]] = CheckpointSegment([block for _, block in run])
+            run = []
+        if child is not None:
+            children[name] = child
+    return children
+
+
+@contextmanager
+def activation_checkpointing(model, every=1, block_names=CHECKPOINT_BLOCKS):
+    """
+    Recompute the activations of the repeated body blocks of model during backward instead of keeping them,
+    e.g. the RRDBs of RRDBNet, the ResidualGroups of RCAN and the LSRAGs of SAN.
+    Backward then costs about one more forward pass of the body.
+    :param every: blocks per checkpoint in Sequential bodies. Backward keeps one input per segment plus the activations
+        of the segment being recomputed, so about the square root of the number of blocks keeps the least.
+        Blocks of a ModuleList its parent calls one by one, as in SAN, are checkpointed one at a time.
+    :param block_names: class names of the blocks to checkpoint
+    Models are shared through the model cache: the first concurrent user patches model, the last restores it,
+    and other users of model in between run with the same checkpoints, which gives the same results.
+    """
+    if not every:
+        yield model
+        return
+    with checkpointing_lock:
+        entry = checkpointed_models.get(id(model))
+        if entry is None:
+            containers = [module for module in model.modules() if isinstance(module, (torch.nn.Sequential, torch.nn.ModuleList)) and
+                          any(type(child).__name__ in block_names for child in module.children())]
+            originals = [(container, container._modules) for container in containers]
+            for container in containers:
+                container._modules = checkpoint_children(container, every, block_names)
+            entry = checkpointed_models[id(model)] = [0, originals]
+        entry[0] += 1
+    try:
+        yield model
+    finally:
+        with checkpointing_lock:
+            entry[0] -= 1
+            if entry[0] == 0:
+                for container, modules in entry[1]:
+                    container._modules = modules
+                del checkpointed_models[id(model)]
 
 
 def getLayers(model):
@@ -1,3 +1,6 @@
+import functools
+import itertools
+import contextlib
 import numpy as np
 import torch
 import cv2
@@ -5,6 +8,10 @@ from ModelZoo.utils import _add_batch_one, _remove_batch
 from SaliencyModel.utils import grad_norm, IG_baseline, interpolation, isotropic_gaussian_kernel
 
 
+class PathGradientCancelled(Exception):
+    pass
+
+
 def attribution_objective(attr_func, h, w, window=16):
     def calculate_objective(image):
         return attr_func(image, h, w, window=window)
@@ -37,20 +44,38 @@ def I_gradient(numpy_image, baseline_image, model, attr_objective, fold, interp=
     return grad_list, results_numpy, interpolated
 
 
+@functools.lru_cache(maxsize=16)
+def gaussian_blur_kernel_bank(sigma, fold, l=5):
+    """
+    Separable factors of the fold + 1 isotropic Gaussian kernels of the blur path, built once per (sigma, fold, l).
+    :return: (fold + 1) x l float32 array, read-only
+    """
+    sigma_interpolation = np.linspace(sigma, 0, fold + 1)
+    # isotropic_gaussian_kernel is the outer product of its (normalized) marginal with itself
+    factors = np.stack([isotropic_gaussian_kernel(l, s).sum(axis=0) for s in sigma_interpolation]).astype(np.float32)
+    factors.setflags(write=False)
+    return factors
+
+
 def GaussianBlurPath(sigma, fold, l=5):
     def path_interpolation_func(cv_numpy_image):
         h, w, c = cv_numpy_image.shape
-        kernel_interpolation = np.zeros((fold + 1, l, l))
-        image_interpolation = np.zeros((fold, h, w, c))
-        lambda_derivative_interpolation = np.zeros((fold, h, w, c))
-        sigma_interpolation = np.linspace(sigma, 0, fold + 1)
-        for i in range(fold + 1):
-            kernel_interpolation[i] = isotropic_gaussian_kernel(l, sigma_interpolation[i])
+        factors = gaussian_blur_kernel_bank(sigma, fold, l)
+        planes = np.ascontiguousarray(np.moveaxis(cv_numpy_image, 2, 0), dtype=np.float32)
+        image_interpolation = np.empty((fold, c, h, w), dtype=np.float32)
+        lambda_derivative_interpolation = np.empty((fold, c, h, w), dtype=np.float32)
+        # Separable filtering of each channel plane straight into the channel-first output,
+        # with the same BORDER_REFLECT_101 default as cv2.filter2D
         for i in range(fold):
-            image_interpolation[i] = cv2.filter2D(cv_numpy_image, -1, kernel_interpolation[i + 1])
-            lambda_derivative_interpolation[i] = cv2.filter2D(cv_numpy_image, -1, (kernel_interpolation[i + 1] - kernel_interpolation[i]) * fold)
-        return np.moveaxis(image_interpolation, 3, 1).astype(np.float32), \
-               np.moveaxis(lambda_derivative_interpolation, 3, 1).astype(np.float32)
+            for j in range(c):
+                cv2.sepFilter2D(planes[j], -1, factors[i + 1], factors[i + 1], dst=image_interpolation[i, j])
+        # d\lambda/d\alpha by linearity of the convolution: (blur_{i+1} - blur_i) * fold
+        for j in range(c):
+            cv2.sepFilter2D(planes[j], -1, factors[0], factors[0], dst=lambda_derivative_interpolation[0, j])
+        np.subtract(image_interpolation[0], lambda_derivative_interpolation[0], out=lambda_derivative_interpolation[0])
+        np.subtract(image_interpolation[1:], image_interpolation[:-1], out=lambda_derivative_interpolation[1:])
+        lambda_derivative_interpolation *= fold
+        return image_interpolation, lambda_derivative_interpolation
     return path_interpolation_func
 
 
@@ -75,43 +100,235 @@ def LinearPath(fold):
     return path_interpolation_func
 
 
-def Path_gradient(numpy_image, model, attr_objective, path_interpolation_func, cuda=False):
+class PathSteps:
+    """
+    Lazily evaluated interpolation path of fold steps.
+    :param fold: number of steps
+    :param steps: callable returning a new iterator of (image_i, dlambda_i), C x H x W float32
+    """
+
+    def __init__(self, fold, steps):
+        self.fold = fold
+        self.steps = steps
+
+    def __len__(self):
+        return self.fold
+
+    def __iter__(self):
+        return self.steps()
+
+
+def iter_path_batches(path, batch_size=1):
+    """
+    :param path: (image_interpolation, lambda_derivative_interpolation) arrays or PathSteps
+    :return: generator of (images, lambda_derivatives) micro-batches, batch_size x C x H x W
+    """
+    if not isinstance(path, PathSteps):
+        image_interpolation, lambda_derivative_interpolation = path
+        for start in range(0, len(image_interpolation), batch_size):
+            yield image_interpolation[start:start + batch_size], lambda_derivative_interpolation[start:start + batch_size]
+        return
+    steps = iter(path)
+    while True:
+        batch = list(itertools.islice(steps, batch_size))
+        if not batch:
+            return
+        images, lambda_derivatives = zip(*batch)
+        yield np.stack(images), np.stack(lambda_derivatives)
+
+
+def GaussianBlurPathSteps(sigma, fold, l=5):
+    """
+    GaussianBlurPath evaluated lazily: two blurred images are held at a time instead of the fold-deep stacks.
+    """
+    def path_interpolation_func(cv_numpy_image):
+        h, w, c = cv_numpy_image.shape
+        factors = gaussian_blur_kernel_bank(sigma, fold, l)
+        planes = np.ascontiguousarray(np.moveaxis(cv_numpy_image, 2, 0), dtype=np.float32)
+
+        def blur(i):
+            blurred = np.empty((c, h, w), dtype=np.float32)
+            for j in range(c):
+                cv2.sepFilter2D(planes[j], -1, factors[i], factors[i], dst=blurred[j])
+            return blurred
+
+        def steps():
+            previous = blur(0)
+            for i in range(fold):
+                image = blur(i + 1)
+                yield image, (image - previous) * fold
+                previous = image
+
+        return PathSteps(fold, steps)
+    return path_interpolation_func
+
+
+def get_device(device=None):
+    """
+    :param device: 'cuda', 'cpu' or None to use CUDA when it is available
+    :return: torch.device
+    """
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+
+AUTOCAST_DTYPES = {
+    'bf16': torch.bfloat16,
+    'bfloat16': torch.bfloat16,
+    'fp16': torch.float16,
+    'float16': torch.float16,
+}
+
+
+def autocast(device, precision=None):
+    """
+    :param precision: one of AUTOCAST_DTYPES, None for float32
+    :return: autocast context of the forward pass
+    """
+    if precision is None:
+        return contextlib.nullcontext()
+    if precision not in AUTOCAST_DTYPES:
+        raise ValueError(f'Unknown precision {precision}, expected one of {list(AUTOCAST_DTYPES)}')
+    return torch.autocast(device_type=device.type, dtype=AUTOCAST_DTYPES[precision])
+
+
+def Path_gradient(numpy_image, model, attr_objective, path_interpolation_func, cuda=False, batch_size=1, cancel_event=None, device=None,
+                  precision=None, lean=False):
     """
     :param path_interpolation_func:
         return \lambda(\alpha) and d\lambda(\alpha)/d\alpha, for \alpha\in[0, 1]
         This function return pil_numpy_images
+        or a PathSteps of them, consumed one micro-batch at a time and returned in place of the interpolation
+    :param batch_size: number of interpolation steps per forward/backward pass.
+        The objective is evaluated per step and summed, so the gradients match batch_size=1.
+    :param cancel_event: threading.Event checked before each micro-batch, raises PathGradientCancelled once set
+    :param device: torch device to run on, overrides cuda
+    :param precision: 'bf16' or 'fp16' to run the forward passes under autocast,
+        the objective, gradients and grad * lambda_derivative are still computed in float32
+    :param lean: keep a running float32 sum of grad * lambda_derivative and only the final SR output, so memory does not grow with fold.
+        The grads returned are then their mean, shaped 1 x C x H x W, and the results only hold the last step; saliency_map_PG gives the same map.
     :return:
     """
-    if cuda:
-        model = model.cuda()
+    device = torch.device(device) if device is not None else torch.device('cuda' if cuda else 'cpu')
+    # channels_last lets oneDNN pick its blocked convolution kernels on CPU
+    memory_format = torch.channels_last if device.type == 'cpu' else torch.contiguous_format
+    model = model.to(device, memory_format=memory_format)
     cv_numpy_image = np.moveaxis(numpy_image, 0, 2)
-    image_interpolation, lambda_derivative_interpolation = path_interpolation_func(cv_numpy_image)
-    grad_accumulate_list = np.zeros_like(image_interpolation)
+    path = path_interpolation_func(cv_numpy_image)
+    if isinstance(path, PathSteps):
+        image_interpolation = path
+    else:
+        image_interpolation, lambda_derivative_interpolation = path
+    fold = len(image_interpolation)
+    grad_accumulate_list = np.zeros((1 if lean else fold,) + numpy_image.shape, dtype=np.float32)
     result_list = []
-    for i in range(image_interpolation.shape[0]):
-        img_tensor = torch.from_numpy(image_interpolation[i])
+    for start, (images, lambda_derivatives) in zip(range(0, fold, batch_size), iter_path_batches(path, batch_size)):
+        if cancel_event is not None and cancel_event.is_set():
+            raise PathGradientCancelled()
+        end = start + len(images)
+        # A copy of the batch only, the path may be shared through a cache or memory-mapped
+        img_tensor = torch.from_numpy(np.array(images, dtype=np.float32))
         img_tensor.requires_grad_(True)
-        if cuda:
-            result = model(_add_batch_one(img_tensor).cuda())
-            target = attr_objective(result)
-            target.backward()
-            grad = img_tensor.grad.cpu().numpy()
-            if np.any(np.isnan(grad)):
-                grad[np.isnan(grad)] = 0.0
-        else:
-            result = model(_add_batch_one(img_tensor))
-            target = attr_objective(result)
-            target.backward()
-            grad = img_tensor.grad.numpy()
-            if np.any(np.isnan(grad)):
-                grad[np.isnan(grad)] = 0.0
-
-        grad_accumulate_list[i] = grad * lambda_derivative_interpolation[i]
-        result_list.append(result.detach().cpu().numpy())
-    result_numpy = np.asarray(result_list)
+        with autocast(device, precision):
+            result = model(img_tensor.to(device, memory_format=memory_format))
+        # The objective compares neighbouring output pixels, which reduced precision rounds together: take it in float32
+        result = result.float()
+        target = sum(attr_objective(result[i:i + 1]) for i in range(end - start))
+        # Only the input gradient is needed, skip the weight gradients backward() would accumulate
+        grad = torch.autograd.grad(target, img_tensor)[0].float().cpu().numpy()
+        if np.any(np.isnan(grad)):
+            grad[np.isnan(grad)] = 0.0
+
+        grad *= lambda_derivatives
+        if lean:
+            grad_accumulate_list[0] += grad.sum(axis=0)
+            if end == fold:
+                result_list.append(result[-1:].detach().float().cpu().numpy())
+            continue
+        grad_accumulate_list[start:end] = grad
+        result_numpy = result.detach().float().cpu().numpy()
+        result_list.extend(result_numpy[i:i + 1] for i in range(end - start))
+    if lean:
+        grad_accumulate_list /= fold
     return grad_accumulate_list, result_list, image_interpolation
 
 
+class PathForward:
+    """
+    Forward passes of a whole interpolation path with their autograd graphs kept, so the gradients of any objective
+    of the outputs only cost the backward passes. Built by retain_path_forward.
+    :param batches: list of (img_tensor, result, lambda_derivatives) per micro-batch
+    :param nbytes: bytes of the batches and of the tensors the graphs saved for backward, besides the model parameters
+    """
+
+    def __init__(self, batches, nbytes):
+        self.batches = batches
+        self.nbytes = nbytes
+
+    def __len__(self):
+        return sum(len(result) for _, result, _ in self.batches)
+
+
+def retain_path_forward(numpy_image, model, path_interpolation_func, batch_size=1, cancel_event=None, device=None, precision=None):
+    """
+    Run the forward passes of Path_gradient once and keep their graphs, see PathForward.
+    """
+    device = torch.device(device) if device is not None else torch.device('cpu')
+    memory_format = torch.channels_last if device.type == 'cpu' else torch.contiguous_format
+    model = model.to(device, memory_format=memory_format)
+    path = path_interpolation_func(np.moveaxis(numpy_image, 0, 2))
+    parameters = {parameter.untyped_storage().data_ptr() for parameter in model.parameters()}
+    storages = {}
+
+    def count(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in parameters:
+            storages[storage.data_ptr()] = storage.nbytes()
+
+    def pack(tensor):
+        count(tensor)
+        return tensor
+
+    batches = []
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        for images, lambda_derivatives in iter_path_batches(path, batch_size):
+            if cancel_event is not None and cancel_event.is_set():
+                raise PathGradientCancelled()
+            img_tensor = torch.from_numpy(np.array(images, dtype=np.float32))
+            img_tensor.requires_grad_(True)
+            with autocast(device, precision):
+                result = model(img_tensor.to(device, memory_format=memory_format))
+            result = result.float()
+            lambda_derivatives = np.array(lambda_derivatives, dtype=np.float32)
+            batches.append((img_tensor, result, lambda_derivatives))
+            # The inputs and outputs are kept by the batches even where backward does not save them.
+            count(img_tensor)
+            count(result)
+            storages[('lambda_derivatives', len(batches))] = lambda_derivatives.nbytes
+    return PathForward(batches, sum(storages.values()))
+
+
+def retained_path_gradient(path_forward, attr_objective, cancel_event=None):
+    """
+    Path_gradient in lean mode over the retained graphs of path_forward, which stay usable for the next objective.
+    :return: grads (1 x C x H x W mean of grad * lambda_derivative), results (the last step only)
+    """
+    grad_accumulate = None
+    for img_tensor, result, lambda_derivatives in path_forward.batches:
+        if cancel_event is not None and cancel_event.is_set():
+            raise PathGradientCancelled()
+        target = sum(attr_objective(result[i:i + 1]) for i in range(len(result)))
+        grad = torch.autograd.grad(target, img_tensor, retain_graph=True)[0].float().cpu().numpy()
+        if np.any(np.isnan(grad)):
+            grad[np.isnan(grad)] = 0.0
+        grad *= lambda_derivatives
+        grad_accumulate = grad.sum(axis=0, keepdims=True) if grad_accumulate is None else grad_accumulate + grad.sum(axis=0)
+    grad_accumulate /= len(path_forward)
+    result = path_forward.batches[-1][1]
+    return grad_accumulate, [result[-1:].detach().float().cpu().numpy()]
+
+
 def saliency_map_PG(grad_list, result_list):
     final_grad = grad_list.mean(axis=0)
     return final_grad, result_list[-1]
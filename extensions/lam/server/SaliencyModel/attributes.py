@@ -48,7 +48,8 @@ def attr_grad(tensor, h, w, window=8, reduce='sum'):
     w_x = tensor.size()[3]
     h_grad = torch.pow(tensor[:, :, :h_x - 1, :] - tensor[:, :, 1:, :], 2)
     w_grad = torch.pow(tensor[:, :, :, :w_x - 1] - tensor[:, :, :, 1:], 2)
-    grad = torch.pow(h_grad[:, :, :, :-1] + w_grad[:, :, :-1, :], 1 / 2)
+    # The square root has no derivative at 0, where neighbouring pixels are equal (often, in reduced precision)
+    grad = torch.pow(h_grad[:, :, :, :-1] + w_grad[:, :, :-1, :] + 1e-8, 1 / 2)
     crop = grad[:, :, h: h + window, w: w + window]
     return reduce_func(reduce)(crop)
 
@@ -351,7 +351,7 @@ def inv_fft_kernel_est(ker_f, ker_p):
         print(f'inv_denominator : {inv_denominator}')
         assert False, 'inv_denominator is nan'  
     # pseudo inverse kernel in flourier domain.
-    inv_ker_f = torch.zeros_like(ker_f).cuda()
+    inv_ker_f = torch.zeros_like(ker_f)
     inv_ker_f.real = ker_f.real / inv_denominator
     inv_ker_f.imag = -ker_f.imag / inv_denominator
     if torch.isnan(inv_ker_f).any():
@@ -363,7 +363,7 @@ def inv_fft_kernel_est(ker_f, ker_p):
 # --------------------------------
 def deconv(inv_ker_f, fft_input_blur):
     # delement-wise multiplication.
-    deblur_f = torch.zeros_like(inv_ker_f).cuda()
+    deblur_f = torch.zeros_like(inv_ker_f)
     deblur_f.real = inv_ker_f.real * fft_input_blur.real \
                             - inv_ker_f.imag * fft_input_blur.imag
     deblur_f.imag = inv_ker_f.real * fft_input_blur.imag \
@@ -381,7 +381,7 @@ def deconv(inv_ker_f, fft_input_blur):
 # --------------------------------
 # --------------------------------
 def convert_psf2otf(ker, size):
-    psf = torch.zeros(size).cuda()
+    psf = torch.zeros(size, dtype=ker.dtype, device=ker.device)
 
     # circularly shift
     centre = ker.shape[2]//2 + 1
@@ -0,0 +1,65 @@
+import functools
+import cv2
+import numpy as np
+
+
+# matplotlib's 'seismic': evenly spaced RGB anchors of a linear segmented colormap
+SEISMIC = ((0.0, 0.0, 0.3), (0.0, 0.0, 1.0), (1.0, 1.0, 1.0), (1.0, 0.0, 0.0), (0.5, 0.0, 0.0))
+
+
+@functools.lru_cache(maxsize=None)
+def colormap_lut(colors=SEISMIC, n=256):
+    """
+    uint8 RGB lookup table of a colormap, sampled like matplotlib's LinearSegmentedColormap.from_list(colors, N=n).
+    :return: read-only (n + 1) x 3 array, the last entry is the colour of NaN
+    """
+    anchors = np.linspace(0., 1., len(colors)) * (n - 1)
+    samples = (n - 1) * np.linspace(0., 1., n)
+    # Same arithmetic as matplotlib, so the truncation to uint8 matches it bit for bit.
+    ind = np.searchsorted(anchors, samples[1:-1])
+    distance = (samples[1:-1] - anchors[ind - 1]) / (anchors[ind] - anchors[ind - 1])
+    lut = np.zeros((n + 1, 3), dtype=np.uint8)
+    for c, channel in enumerate(zip(*colors)):
+        channel = np.array(channel)
+        values = np.concatenate([channel[:1], distance * (channel[ind] - channel[ind - 1]) + channel[ind - 1], channel[-1:]])
+        lut[:n, c] = (255 * np.clip(values, 0., 1.)).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def colormap_index(values, n=256):
+    """
+    :param values: array in [0, 1], clipped outside
+    :return: LUT index of every value, n for NaN
+    """
+    index = np.clip(np.nan_to_num(values * n, nan=-1.), 0, n - 1).astype(np.uint16)
+    index[np.isnan(values)] = n
+    return index
+
+
+def apply_colormap(values, zoomin=1, interpolation='nearest', colors=SEISMIC, n=256, bgr=False):
+    """
+    Colour values through a precomputed LUT of the colormap, upsampled zoomin times.
+    :param values: 2D array in [0, 1]
+    :param interpolation: 'nearest' or 'bicubic' upsampling of the colours
+    :param n: number of LUT entries, e.g. 256 like matplotlib or 1024 for smoother gradients
+    :param bgr: channel order of the result, RGB when False
+    :return: uint8 H*zoomin x W*zoomin x 3 array
+    """
+    lut = colormap_lut(colors, n)
+    if bgr:
+        lut = lut[:, ::-1]
+    colored = np.ascontiguousarray(lut[colormap_index(values, n)])
+    if zoomin == 1:
+        return colored
+    height, width = values.shape
+    if interpolation not in ('nearest', 'bicubic'):
+        raise ValueError(f'Unknown interpolation {interpolation}')
+    return cv2.resize(colored, (width * zoomin, height * zoomin), interpolation=cv2.INTER_NEAREST if interpolation == 'nearest' else cv2.INTER_CUBIC)
+
+
+def blend(foreground, background, alpha=0.5):
+    """
+    :return: foreground * (1 - alpha) + background * alpha in uint8, computed in one pass
+    """
+    return cv2.addWeighted(foreground, 1.0 - alpha, background, alpha, 0)
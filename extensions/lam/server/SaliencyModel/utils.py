@@ -1,9 +1,8 @@
 import numpy as np
 import cv2
-from scipy import stats
-import matplotlib.pyplot as plt
-import matplotlib as mpl
+from scipy import signal
 from PIL import Image
+from SaliencyModel.render import apply_colormap
 import cv2
 
 
@@ -42,54 +41,57 @@ def count_saliency_pixels(map, threshold=0.95):
     return len(cum_sum[cum_sum < sum_threshold])
 
 
+def grid_kde(weights, truncate=5.):
+    """
+    Weighted Gaussian KDE of the pixel positions, evaluated on the pixel grid, up to a constant factor.
+    Same as scipy.stats.gaussian_kde(pixels, weights=weights.ravel())(pixels) with Scott's rule, but computed
+    as one FFT convolution of the weights with the kernel instead of O(N^2) pairwise sums.
+    :param weights: 2D non-negative array
+    :param truncate: kernel radius in standard deviations
+    :return: 2D density, same shape as weights
+    """
+    height, width = weights.shape
+    total = weights.sum(dtype=np.float64)
+    if total <= 0:
+        return np.zeros(weights.shape)
+    weights = weights / total
+    Y, X = np.mgrid[0:height:1, 0:width:1]
+    neff = 1. / np.sum(weights ** 2)
+    covariance = np.cov(np.vstack([X.ravel(), Y.ravel()]), aweights=weights.ravel()) * neff ** (-2. / 6)
+    inv_covariance = np.linalg.pinv(covariance)
+
+    radius_x = min(width - 1, int(np.ceil(truncate * np.sqrt(covariance[0, 0]))))
+    radius_y = min(height - 1, int(np.ceil(truncate * np.sqrt(covariance[1, 1]))))
+    dy, dx = np.mgrid[-radius_y:radius_y + 1, -radius_x:radius_x + 1]
+    kernel = np.exp(-0.5 * (inv_covariance[0, 0] * dx ** 2 + 2 * inv_covariance[0, 1] * dx * dy + inv_covariance[1, 1] * dy ** 2))
+    return np.maximum(signal.fftconvolve(weights, kernel, mode='same'), 0)
+
+
 def plot_diff_of_attrs_kde(A, B, zoomin=4, blend=0.5):
-    grad_flat = A.reshape((-1))
-    datapoint_y, datapoint_x = np.mgrid[0:A.shape[0]:1, 0:A.shape[1]:1]
-    Y, X = np.mgrid[0:A.shape[0]:1, 0:A.shape[1]:1]
-    positions = np.vstack([X.ravel(), Y.ravel()])
-    pixels = np.vstack([datapoint_x.ravel(), datapoint_y.ravel()])
-    kernel = stats.gaussian_kde(pixels, weights=grad_flat)
-    Za = np.reshape(kernel(positions).T, A.shape)
+    Za = grid_kde(A)
     Za = Za / Za.max()
 
-    grad_flat = B.reshape((-1))
-    datapoint_y, datapoint_x = np.mgrid[0:B.shape[0]:1, 0:B.shape[1]:1]
-    Y, X = np.mgrid[0:B.shape[0]:1, 0:B.shape[1]:1]
-    positions = np.vstack([X.ravel(), Y.ravel()])
-    pixels = np.vstack([datapoint_x.ravel(), datapoint_y.ravel()])
-    kernel = stats.gaussian_kde(pixels, weights=grad_flat)
-    Zb = np.reshape(kernel(positions).T, B.shape)
+    Zb = grid_kde(B)
     Zb = Zb / Zb.max()
 
     diff = Za - Zb
     diff_norm = diff / diff.max()
     vis = Zb - blend*diff_norm
 
-    cmap = plt.get_cmap('seismic')
-    # cmap = plt.get_cmap('Purples')
-    map_color = (255 * cmap(vis * 0.5 + 0.5)).astype(np.uint8)
-    # map_color = (255 * cmap(Z)).astype(np.uint8)
-    Img = Image.fromarray(map_color)
-    s1, s2 = Img.size
-    return Img.resize((s1 * zoomin, s2 * zoomin), Image.BICUBIC)
+    return Image.fromarray(apply_colormap(vis * 0.5 + 0.5, zoomin=zoomin, interpolation='bicubic'))
+
+
+def saliency_kde(map):
+    """
+    :param map: the saliency map, 2D, norm to [0, 1]
+    :return: its kernel density estimate, norm to [0, 1]
+    """
+    Z = grid_kde(map)
+    return Z / Z.max()
 
 
 def vis_saliency_kde(map, zoomin=4):
-    grad_flat = map.reshape((-1))
-    datapoint_y, datapoint_x = np.mgrid[0:map.shape[0]:1, 0:map.shape[1]:1]
-    Y, X = np.mgrid[0:map.shape[0]:1, 0:map.shape[1]:1]
-    positions = np.vstack([X.ravel(), Y.ravel()])
-    pixels = np.vstack([datapoint_x.ravel(), datapoint_y.ravel()])
-    kernel = stats.gaussian_kde(pixels, weights=grad_flat)
-    Z = np.reshape(kernel(positions).T, map.shape)
-    Z = Z / Z.max()
-    cmap = plt.get_cmap('seismic')
-    # cmap = plt.get_cmap('Purples')
-    map_color = (255 * cmap(Z * 0.5 + 0.5)).astype(np.uint8)
-    # map_color = (255 * cmap(Z)).astype(np.uint8)
-    Img = Image.fromarray(map_color)
-    s1, s2 = Img.size
-    return Img.resize((s1 * zoomin, s2 * zoomin), Image.BICUBIC)
+    return Image.fromarray(apply_colormap(saliency_kde(map) * 0.5 + 0.5, zoomin=zoomin, interpolation='bicubic'))
 
 
 def vis_saliency(map, zoomin=4):
@@ -98,14 +100,7 @@ def vis_saliency(map, zoomin=4):
     :param zoomin: the resize factor, nn upsample
     :return:
     """
-    cmap = plt.get_cmap('seismic')
-    # cmap = plt.get_cmap('Purples')
-    map_color = (255 * cmap(map * 0.5 + 0.5)).astype(np.uint8)
-    # map_color = (255 * cmap(map)).astype(np.uint8)
-    Img = Image.fromarray(map_color)
-    s1, s2 = Img.size
-    Img = Img.resize((s1 * zoomin, s2 * zoomin), Image.NEAREST)
-    return Img.convert('RGB')
+    return Image.fromarray(apply_colormap(map * 0.5 + 0.5, zoomin=zoomin))
 
 
 def click_select_position(pil_img, window_size=16):
@@ -0,0 +1,187 @@
+import os
+import json
+import time
+import shutil
+import argparse
+import cv2
+import numpy as np
+import torch
+from os import path as osp
+from cache import LRUCache, DiskLRU
+from lam import lam_input, cached_blur_path, get_diffusion_index, result_store, device
+from SaliencyModel.attributes import attr_grad
+from SaliencyModel.BackProp import attribution_objective, autocast, iter_path_batches, PathGradientCancelled
+from SaliencyModel.render import apply_colormap
+
+ATLAS_DIR = os.environ.get('LAM_ATLAS_DIR', osp.expanduser('~/.cache/lam/atlas'))
+# Atlases in ATLAS_DIR, least recently used deleted first past LAM_ATLAS_BYTES: callers add a new one once they are done reading it
+atlas_disk = DiskLRU(ATLAS_DIR, int(os.environ.get('LAM_ATLAS_BYTES', 32 * 1024 ** 3)))
+atlas_cache = LRUCache(16)
+
+
+def atlas_path(model_file, img_path, window_size, data_range=1., sigma=1.2, fold=50, l=9, precision=None, model_options=None,
+               directory=ATLAS_DIR):
+    """
+    Directory of the atlas of a (model, image) pair, from the content of both and every parameter besides the stride.
+    :param model_options: model_loader.get_model_options of the model, see lam_result_key
+    """
+    key = result_store.make_key(model_file, img_path, atlas=True, model_options=model_options, window_size=window_size, data_range=data_range,
+                                sigma=sigma, fold=fold, l=l, precision=precision)
+    return osp.join(directory, key)
+
+
+def build_atlas(model, tensor_lr, target, window_size=16, stride=8, data_range=1., batch_size=1, sigma=1.2, fold=50, l=9, precision=None,
+                cancel_event=None, progress=None, info=None):
+    """
+    LAM of every window_size window on a stride grid of the SR output, all from one pass over the blur path:
+    each micro-batch runs forward once, then backward once per window.
+    Written to the directory target:
+        attribution.npy: windows x H x W float16 normalized absolute attribution (grad_abs_norm) of every window, row major
+        diffusion_index.npy: rows x columns float32 diffusion index grid, and diffusion_index.png as a seismic heatmap
+        result.npy: final SR output, in [0, 1], shared by all windows
+        meta.json: parameters and grid
+    :param progress: callable(fraction done), called after every window
+    :param info: extra fields of meta.json
+    :return: meta
+    """
+    start_time = time.time()
+    numpy_image = lam_input(tensor_lr, data_range)
+    memory_format = torch.channels_last if device.type == 'cpu' else torch.contiguous_format
+    model = model.to(device, memory_format=memory_format)
+    path = cached_blur_path(sigma, fold, l)(np.moveaxis(numpy_image, 0, 2))
+    temp = f'{target}.{os.getpid()}.tmp'
+    os.makedirs(temp)
+    try:
+        grad_sums = None
+        done = 0
+        for images, lambda_derivatives in iter_path_batches(path, batch_size):
+            img_tensor = torch.from_numpy(np.array(images, dtype=np.float32))
+            img_tensor.requires_grad_(True)
+            with autocast(device, precision):
+                result = model(img_tensor.to(device, memory_format=memory_format))
+            result = result.float()
+            if grad_sums is None:
+                rows = range(0, result.shape[2] - window_size + 1, stride)
+                columns = range(0, result.shape[3] - window_size + 1, stride)
+                positions = [(h, w) for h in rows for w in columns]
+                if not positions:
+                    raise ValueError(f'Window {window_size} larger than the SR output {tuple(result.shape[2:])}')
+                # Channel sums of grad * lambda_derivative over the path, on disk as they do not have to fit in RAM
+                grad_sums = np.lib.format.open_memmap(osp.join(temp, 'grad_sums.npy'), mode='w+', dtype=np.float32,
+                                                      shape=(len(positions),) + numpy_image.shape[1:])
+            for index, (h, w) in enumerate(positions):
+                if cancel_event is not None and cancel_event.is_set():
+                    raise PathGradientCancelled()
+                attr_objective = attribution_objective(attr_grad, h, w, window=window_size)
+                objective = sum(attr_objective(result[i:i + 1]) for i in range(len(result)))
+                grad = torch.autograd.grad(objective, img_tensor, retain_graph=index < len(positions) - 1)[0].float().cpu().numpy()
+                if np.any(np.isnan(grad)):
+                    grad[np.isnan(grad)] = 0.0
+                grad_sums[index] += (grad * lambda_derivatives).sum(axis=(0, 1))
+                if progress is not None:
+                    progress((done * len(positions) + index + 1) / (fold * len(positions)))
+            done += len(images)
+        result = result[-1:].detach().float().cpu().numpy()
+        if data_range != 1.:
+            result = result / 2 + 0.5
+
+        attribution = np.lib.format.open_memmap(osp.join(temp, 'attribution.npy'), mode='w+', dtype=np.float16, shape=grad_sums.shape)
+        diffusion_index = np.empty((len(rows), len(columns)), dtype=np.float32)
+        for index in range(len(positions)):
+            grad_2d = np.abs(grad_sums[index])
+            grad_max = grad_2d.max()
+            # A window with no gradient at all keeps an all-zero attribution instead of NaN
+            normed = grad_2d / grad_max if grad_max > 0 else grad_2d
+            attribution[index] = normed
+            diffusion_index.flat[index] = get_diffusion_index(normed)
+        attribution.flush()
+        del attribution, grad_sums
+        os.remove(osp.join(temp, 'grad_sums.npy'))
+        np.save(osp.join(temp, 'result.npy'), result)
+        np.save(osp.join(temp, 'diffusion_index.npy'), diffusion_index)
+        heatmap = apply_colormap(diffusion_index / 100, zoomin=stride, bgr=True)
+        cv2.imwrite(osp.join(temp, 'diffusion_index.png'), heatmap)
+        meta = {
+            'window_size': window_size,
+            'stride': stride,
+            'rows': len(rows),
+            'columns': len(columns),
+            'data_range': data_range,
+            'sigma': sigma,
+            'fold': fold,
+            'l': l,
+            'precision': precision,
+            'seconds': time.time() - start_time,
+            **(info or {}),
+        }
+        with open(osp.join(temp, 'meta.json'), 'w') as file:
+            json.dump(meta, file)
+        if osp.exists(target):
+            shutil.rmtree(target)
+        os.replace(temp, target)
+        return meta
+    finally:
+        if osp.exists(temp):
+            shutil.rmtree(temp)
+
+
+def open_atlas(target):
+    """
+    :return: meta, attribution (memory-mapped), result and diffusion_index of the atlas in target, None when there is none
+    """
+    try:
+        mtime = os.stat(osp.join(target, 'meta.json')).st_mtime_ns
+    except OSError:
+        return None
+    atlas_disk.touch(target)
+
+    def load():
+        with open(osp.join(target, 'meta.json'), 'r') as file:
+            meta = json.load(file)
+        return (meta, np.load(osp.join(target, 'attribution.npy'), mmap_mode='r'), np.load(osp.join(target, 'result.npy')),
+                np.load(osp.join(target, 'diffusion_index.npy')))
+    return atlas_cache.get_or_create((target, mtime), load)
+
+
+def find_atlas(model_file, img_path, h, w, window_size, data_range=1., sigma=1.2, fold=50, l=9, precision=None, model_options=None,
+               directory=ATLAS_DIR):
+    """
+    LAM of the window at (h, w) from the atlas of the model and image, when the window lies on its grid.
+    :return: grad_numpy (1 x H x W, rendered like a compute_lam attribution), result and data.json fields, or None
+    """
+    atlas = open_atlas(atlas_path(model_file, img_path, window_size, data_range=data_range, sigma=sigma, fold=fold, l=l,
+                                  precision=precision, model_options=model_options, directory=directory))
+    if atlas is None:
+        return None
+    meta, attribution, result, diffusion_index = atlas
+    stride = meta['stride']
+    if h % stride or w % stride or not (0 <= h // stride < meta['rows'] and 0 <= w // stride < meta['columns']):
+        return None
+    index = h // stride * meta['columns'] + w // stride
+    return attribution[index][None].astype(np.float32), result, {'atlas': {'stride': stride, 'index': index}}
+
+
+if __name__ == '__main__':
+    from model_loader import get_root_path, get_bare_model, get_model_key, get_model_options
+    from lam import load_img
+
+    parser = argparse.ArgumentParser(description='Precompute the LAM of every window on a stride grid of an image.')
+    parser.add_argument('path', help='model, as in the path of a /lam request')
+    parser.add_argument('file', help='LR image, relative to the root path like the file of a /lam request')
+    parser.add_argument('--window', type=int, default=16)
+    parser.add_argument('--stride', type=int, default=8)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--precision', choices=('bf16', 'fp16'))
+    args = parser.parse_args()
+
+    img_path = f'{get_root_path()}/{args.file}'
+    opt_path, _, checkpoint_path, _ = get_model_key(args.path)
+    _, _, tensor_lr = load_img(img_path)
+    target = atlas_path(checkpoint_path or opt_path, img_path, args.window, data_range=2, precision=args.precision,
+                        model_options=get_model_options(args.path))
+    meta = build_atlas(get_bare_model(args.path), tensor_lr, target, window_size=args.window, stride=args.stride, data_range=2,
+                       batch_size=args.batch_size, precision=args.precision,
+                       progress=lambda fraction: print(f'\r{fraction:.1%}', end='', flush=True),
+                       info={'path': args.path, 'file': args.file})
+    print(f'\n{target}: {meta["rows"]} x {meta["columns"]} windows in {meta["seconds"]:.1f}s')
+    atlas_disk.add(target)
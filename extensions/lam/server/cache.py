@@ -0,0 +1,202 @@
+import os
+import shutil
+import threading
+from os import path as osp
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe LRU mapping bounded by the total size of its values.
+    :param capacity: maximum total size, in the units returned by sizeof
+    :param sizeof: callable returning the size of a value, counts entries when None
+    :param on_evict: callable(key, value) for entries dropped to make room, or too large to keep
+    """
+
+    def __init__(self, capacity, sizeof=None, on_evict=None):
+        self.capacity = capacity
+        self.sizeof = sizeof or (lambda value: 1)
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.RLock()
+        self.pending = {}
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        size = self.sizeof(value)
+        evicted = []
+        with self.lock:
+            self.pop(key)
+            if size > self.capacity:
+                evicted.append((key, value))
+            else:
+                self.entries[key] = (value, size)
+                self.size += size
+            while self.size > self.capacity:
+                evicted_key, (evicted_value, evicted_size) = self.entries.popitem(last=False)
+                evicted.append((evicted_key, evicted_value))
+                self.size -= evicted_size
+                self.evictions += 1
+        if self.on_evict is not None:
+            for evicted_key, evicted_value in evicted:
+                self.on_evict(evicted_key, evicted_value)
+        return value
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            value, size = self.entries.pop(key)
+            self.size -= size
+            return value
+
+    def get_or_create(self, key, factory):
+        """
+        Return the cached value for key, building it with factory() on a miss.
+        Concurrent misses on the same key wait for a single build.
+        """
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key][0]
+            self.misses += 1
+            key_lock = self.pending.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    return self.entries[key][0]
+            try:
+                return self.put(key, factory())
+            finally:
+                with self.lock:
+                    self.pending.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.size,
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def disk_usage(file_path):
+    """
+    :return: bytes of a file, or of every file under a directory
+    """
+    if not osp.isdir(file_path):
+        return os.stat(file_path).st_size
+    size = 0
+    for dirpath, _, filenames in os.walk(file_path):
+        for filename in filenames:
+            try:
+                size += os.stat(osp.join(dirpath, filename)).st_size
+            except OSError:
+                pass
+    return size
+
+
+class DiskLRU:
+    """
+    Files of a directory bounded in total bytes, evicted least recently used first like ResultStore.
+    An entry is every file sharing a name up to its first dot, and is used when one of its files is touched.
+    A subdirectory counts as a file holding everything under it.
+    :param directory: directory of the entries
+    :param capacity: maximum total bytes on disk, None for no bound
+    """
+
+    def __init__(self, directory, capacity=None):
+        self.directory = directory
+        self.capacity = capacity
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self.size = sum(size for _, size, _ in self.scan())
+
+    def scan(self):
+        """
+        :return: list of (mtime, bytes, file paths) for every entry
+        """
+        entries = {}
+        for filename in os.listdir(self.directory):
+            if filename.endswith('.tmp'):
+                continue
+            file_path = osp.join(self.directory, filename)
+            try:
+                mtime = os.stat(file_path).st_mtime
+                file_size = disk_usage(file_path)
+            except OSError:
+                continue
+            name = filename.split('.', 1)[0]
+            last_used, size, files = entries.get(name, (0, 0, ()))
+            entries[name] = (max(last_used, mtime), size + file_size, files + (file_path,))
+        return list(entries.values())
+
+    def touch(self, *file_paths):
+        for file_path in file_paths:
+            try:
+                os.utime(file_path)
+            except OSError:
+                pass
+
+    def add(self, *file_paths):
+        """
+        Account for newly written files, evicting past the capacity.
+        """
+        size = 0
+        for file_path in file_paths:
+            try:
+                size += disk_usage(file_path)
+            except OSError:
+                pass
+        with self.lock:
+            self.size += size
+            if self.capacity is not None and self.size > self.capacity:
+                self.evict()
+
+    def evict(self):
+        entries = sorted(self.scan())
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, files in entries:
+            if self.size <= self.capacity:
+                break
+            for file_path in files:
+                try:
+                    if osp.isdir(file_path):
+                        shutil.rmtree(file_path)
+                    else:
+                        os.remove(file_path)
+                except OSError:
+                    pass
+            self.size -= size
+            self.evictions += 1
@@ -0,0 +1,88 @@
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from SaliencyModel.BackProp import PathGradientCancelled
+
+
+class Job:
+    """
+    A queued LAM computation producing one result per model.
+    :param run: callable(job) that fills job.results / job.errors and checks job.cancel_event,
+        and may publish the members of a result in progress in job.members, and the fraction done in job.progress
+    :param total: number of results the job will produce
+    """
+
+    def __init__(self, run, total):
+        self.id = uuid.uuid4().hex
+        self.run = run
+        self.total = total
+        self.status = 'queued'
+        self.results = {}
+        self.members = {}
+        self.errors = {}
+        self.progress = None
+        self.cancel_event = threading.Event()
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status,
+            'total': self.total,
+            'done': sorted(self.results),
+            'members': {str(index): list(members) for index, members in list(self.members.items())},
+            'errors': self.errors,
+            'progress': self.progress,
+        }
+
+
+class JobManager:
+    def __init__(self, max_workers=1, ttl=600):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.ttl = ttl
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def submit(self, run, total):
+        self.prune()
+        job = Job(run, total)
+        with self.lock:
+            self.jobs[job.id] = job
+        self.executor.submit(self.execute, job)
+        return job
+
+    def execute(self, job):
+        if job.cancel_event.is_set():
+            job.status = 'cancelled'
+        else:
+            job.status = 'running'
+            try:
+                job.run(job)
+                job.status = 'cancelled' if job.cancel_event.is_set() else 'done'
+            except PathGradientCancelled:
+                job.status = 'cancelled'
+            except Exception:
+                job.errors['job'] = traceback.format_exc()
+                job.status = 'error'
+        job.finished = time.time()
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel_event.set()
+            if job.status == 'queued':
+                job.status = 'cancelled'
+        return job
+
+    def prune(self):
+        now = time.time()
+        with self.lock:
+            expired = [job_id for job_id, job in self.jobs.items() if job.finished is not None and now - job.finished > self.ttl]
+            for job_id in expired:
+                del self.jobs[job_id]
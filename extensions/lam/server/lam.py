@@ -1,37 +1,50 @@
-import torch, cv2, os, sys, numpy as np, matplotlib.pyplot as plt
+import torch, cv2, os, sys, numpy as np
 from copy import deepcopy
 from PIL import Image
-from ModelZoo.utils import load_as_tensor, Tensor2PIL, PIL2Tensor, _add_batch_one
+from ModelZoo.utils import load_as_tensor, Tensor2PIL, PIL2Tensor, _add_batch_one, calculate_ERF, activation_checkpointing
 from ModelZoo import get_model, load_model, print_network
 from SaliencyModel.utils import vis_saliency, vis_saliency_kde, click_select_position, grad_abs_norm, grad_norm, prepare_images, make_pil_grid, blend_input
-from SaliencyModel.utils import cv2_to_pil, pil_to_cv2, gini
+from SaliencyModel.utils import cv2_to_pil, pil_to_cv2, gini, saliency_kde
+from SaliencyModel.render import apply_colormap, blend
 from SaliencyModel.attributes import attr_grad
-from SaliencyModel.BackProp import I_gradient, attribution_objective, Path_gradient
+from SaliencyModel.BackProp import I_gradient, attribution_objective, Path_gradient, get_device
 from SaliencyModel.BackProp import saliency_map_PG as saliency_map
-from SaliencyModel.BackProp import GaussianBlurPath
+from SaliencyModel.BackProp import GaussianBlurPath, GaussianBlurPathSteps, PathSteps, iter_path_batches
 from SaliencyModel.utils import grad_norm, IG_baseline, interpolation, isotropic_gaussian_kernel
 from io import BytesIO
 import zipfile
 import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import weakref
+import itertools
+import torch.nn.functional as F
+from cache import LRUCache, DiskLRU
+from result_store import ResultStore
+from path_cache import PathCache, CachedPath, MemmapPath
 
-def load_img(img_path):
-    window_size = 64 # Define windoes_size of D
-    img_lr, img_hr = prepare_images(img_path, window_size=8)  # Change this image name
+def image_nbytes(entry):
+    img_lr, img_hr, tensor_lr = entry
+    pil_nbytes = sum(img.width * img.height * len(img.getbands()) for img in (img_lr, img_hr))
+    return pil_nbytes + tensor_lr.numel() * tensor_lr.element_size()
 
-    tensor_lr = PIL2Tensor(img_lr)[:3] ; tensor_hr = PIL2Tensor(img_hr)[:3]
 
-    cv2_lr = np.moveaxis(tensor_lr.numpy(), 0, 2) ; cv2_hr = np.moveaxis(tensor_hr.numpy(), 0, 2)
+image_cache = LRUCache(int(os.environ.get('LAM_IMAGE_CACHE_BYTES', 512 * 1024 ** 2)), sizeof=image_nbytes)
+def load_img(img_path, scale=4, window_size=8):
+    """
+    Decode img_path into the LR/HR PIL pair and the float32 LR tensor, once per file version.
+    :return: img_lr, img_hr, tensor_lr (shared between callers, do not modify in place)
+    """
+    def prepare():
+        img_lr, img_hr = prepare_images(img_path, scale=scale, window_size=window_size)
+        tensor_lr = PIL2Tensor(img_lr)[:3]
+        return img_lr, img_hr, tensor_lr
 
-    img_lr, img_hr = prepare_images(img_path, window_size=8)  # Change this image name
-
-    return img_lr, img_hr, cv2_lr, cv2_hr, tensor_lr
+    key = (os.path.realpath(img_path), os.stat(img_path).st_mtime_ns, scale, window_size)
+    return image_cache.get_or_create(key, prepare)
 
 def cv2_to_byte_stream(cv_image):
     _, img_encoded = cv2.imencode('.png', cv_image)
-    img_bytes = img_encoded.tobytes()
-    img_io = BytesIO(img_bytes)
-    img_io.seek(0)
-    return img_io
+    return BytesIO(img_encoded)
 
 def pil_to_byte_stream(pil_image):
     cv_image = pil_to_cv2(pil_image)
@@ -47,36 +60,320 @@ def get_diffusion_index(model_abs_normed_grad_numpy):
     diffusion_index = (1 - gini_index) * 100
     return diffusion_index
 
-def cal_lam(model, tensor_lr, img_lr, img_hr, h, w, window_size, data_range=1.):
-    sigma = 1.2 ; fold = 50 ; l = 9 ; alpha = 0.5
+def configure_cpu(num_threads=None):
+    """
+    Set the intra-op thread count used for CPU inference.
+    :param num_threads: defaults to LAM_NUM_THREADS, or every core when unset
+    """
+    num_threads = num_threads or int(os.environ.get('LAM_NUM_THREADS', 0)) or os.cpu_count()
+    torch.set_num_threads(num_threads)
+
+
+device = get_device(os.environ.get('LAM_DEVICE'))
+if device.type == 'cpu':
+    configure_cpu()
+
+result_store = ResultStore(os.environ.get('LAM_RESULT_CACHE_DIR', os.path.expanduser('~/.cache/lam/results')),
+                           int(os.environ.get('LAM_RESULT_CACHE_BYTES', 2 * 1024 ** 3)))
+def lam_result_key(model_file, img_path, h, w, window_size, data_range=1., sigma=1.2, fold=50, l=9, crop_rf=False,
+                   fmt='png', compression=None, raw_dtype='float16', precision=None, model_options=None):
+    """
+    Content hash of everything a LAM result depends on.
+    :param model_file: checkpoint (or option file when there is none) of the model
+    :param model_options: model_loader.get_model_options of the model, as option files may share a checkpoint
+    """
+    return result_store.make_key(model_file, img_path, model_options=model_options, h=h, w=w, window_size=window_size, data_range=data_range,
+                                 sigma=sigma, fold=fold, l=l,
+                                 crop_rf=crop_rf, fmt=fmt, compression=compression, raw_dtype=raw_dtype, precision=precision)
+
+def lam_input(tensor_lr, data_range=1.):
+    return tensor_lr.numpy() * 2 - 1 if data_range != 1. else tensor_lr.numpy()
+
+path_cache = PathCache(int(os.environ.get('LAM_PATH_CACHE_BYTES', 1024 ** 3)), spill_dir=os.environ.get('LAM_PATH_SPILL_DIR'),
+                       spill_capacity=int(os.environ.get('LAM_PATH_SPILL_BYTES', 8 * 1024 ** 3)))
+path_ram_budget = int(os.environ.get('LAM_PATH_RAM_BYTES', path_cache.memory.capacity))
+path_memmap_dir = os.environ.get('LAM_PATH_MEMMAP_DIR')
+path_memmap_disk = DiskLRU(path_memmap_dir, int(os.environ.get('LAM_PATH_MEMMAP_BYTES', 32 * 1024 ** 3))) if path_memmap_dir is not None else None
+def cached_blur_path(sigma=1.2, fold=50, l=9):
+    """
+    GaussianBlurPath served from path_cache, so moving the window or switching model reuses the path of an image.
+    Paths larger than path_ram_budget are evaluated lazily instead, and written to path_memmap_dir when it is set,
+    which keeps at most LAM_PATH_MEMMAP_BYTES of them.
+    """
+    in_memory = CachedPath(path_cache, GaussianBlurPath(sigma, fold, l), 'gaussian_blur', sigma, fold, l)
+    lazy = GaussianBlurPathSteps(sigma, fold, l)
+    if path_memmap_disk is not None:
+        lazy = MemmapPath(lazy, path_memmap_disk, 'gaussian_blur', sigma, fold, l)
+
+    def path_interpolation_func(cv_numpy_image):
+        # image and lambda-derivative stacks in float32
+        if 2 * fold * cv_numpy_image.size * 4 <= path_ram_budget:
+            return in_memory(cv_numpy_image)
+        return lazy(cv_numpy_image)
+    return path_interpolation_func
+
+def crop_path(path, top, left, bottom, right):
+    if isinstance(path, PathSteps):
+        return PathSteps(len(path), lambda: ((image[:, top:bottom, left:right], lambda_derivative[:, top:bottom, left:right])
+                                             for image, lambda_derivative in path))
+    image_interpolation, lambda_derivative_interpolation = path
+    return image_interpolation[:, :, top:bottom, left:right], lambda_derivative_interpolation[:, :, top:bottom, left:right]
+
+effective_receptive_fields = weakref.WeakKeyDictionary()
+def receptive_field_box(model, shape, h, w, window_size, scale=4, align=8):
+    """
+    LR box holding the HR window at (h, w) plus the model's effective receptive field around it.
+    :param shape: C x H x W of the LR input
+    :param align: the box is grown to multiples of align, like the padding in load_img
+    :return: top, left, bottom, right
+    """
+    if model not in effective_receptive_fields:
+        effective_receptive_fields[model] = calculate_ERF(model)
+    # one extra pixel for the neighbour differences taken by attr_grad
+    halo = effective_receptive_fields[model] + 1
+    _, height, width = shape
+    top = max(0, (h // scale - halo) // align * align)
+    left = max(0, (w // scale - halo) // align * align)
+    bottom = min(height, -(-((h + window_size) // scale + 1 + halo) // align) * align)
+    right = min(width, -(-((w + window_size) // scale + 1 + halo) // align) * align)
+    return top, left, bottom, right
+
+default_checkpoint_every = int(os.environ.get('LAM_CHECKPOINT_EVERY', 0)) or None
+def compute_lam(model, tensor_lr, h, w, window_size, data_range=1., batch_size=1, path_func=None, cancel_event=None,
+                sigma=1.2, fold=50, l=9, device=device, crop_rf=False, scale=4, precision=None, report=None, checkpoint_every=None):
+    """
+    Run the path integration of LAM.
+    :param crop_rf: only feed the window plus the model's effective receptive field through the network,
+        then pad the attribution back to full frame. Outside the box the SR output is bicubic.
+    :param precision: 'bf16' or 'fp16' autocast of the network passes, see Path_gradient
+    :param report: dict updated with the precision_check of a reduced precision run
+    :param checkpoint_every: recompute the body blocks of the model during backward, this many per checkpoint,
+        see activation_checkpointing. LAM_CHECKPOINT_EVERY when None, 0 to keep every activation.
+    :return: grad_numpy (C x H x W attribution), result (final SR output in [0, 1])
+    """
+    if crop_rf:
+        model = model.to(device)
+        top, left, bottom, right = receptive_field_box(model, tensor_lr.shape, h, w, window_size, scale=scale)
+        full_path_func = path_func or cached_blur_path(sigma, fold, l)
+        # Blur the full image and crop the path, so the crop borders see the same path as without cropping.
+        def crop_path_func(cv_numpy_image):
+            return crop_path(full_path_func(np.moveaxis(lam_input(tensor_lr, data_range), 0, 2)), top, left, bottom, right)
+
+        crop_grad, crop_result = compute_lam(model, tensor_lr[:, top:bottom, left:right], h - top * scale, w - left * scale, window_size,
+                                             data_range=data_range, batch_size=batch_size, path_func=crop_path_func,
+                                             cancel_event=cancel_event, device=device, precision=precision, report=report,
+                                             checkpoint_every=checkpoint_every)
+        grad_numpy = np.zeros(tensor_lr.shape, dtype=crop_grad.dtype)
+        grad_numpy[:, top:bottom, left:right] = crop_grad
+        result = F.interpolate(tensor_lr[None], scale_factor=scale, mode='bicubic', align_corners=False).numpy()
+        result[:, :, top * scale:bottom * scale, left * scale:right * scale] = crop_result
+        return grad_numpy, result
+
     attr_objective = attribution_objective(attr_grad, h, w, window=window_size)
-    gaus_blur_path_func = GaussianBlurPath(sigma, fold, l)
-    interpolated_grad_numpy, result_numpy, interpolated_numpy = Path_gradient(tensor_lr.numpy() * 2 - 1, model, attr_objective, gaus_blur_path_func, cuda=True) if data_range != 1. else Path_gradient(tensor_lr.numpy(), model, attr_objective, gaus_blur_path_func, cuda=True)
+    gaus_blur_path_func = path_func or cached_blur_path(sigma, fold, l)
+    checkpoint_every = default_checkpoint_every if checkpoint_every is None else checkpoint_every
+    with activation_checkpointing(model, checkpoint_every):
+        interpolated_grad_numpy, result_numpy, interpolated_numpy = Path_gradient(lam_input(tensor_lr, data_range), model, attr_objective, gaus_blur_path_func, batch_size=batch_size, cancel_event=cancel_event, device=device, precision=precision, lean=True)
+        if precision is not None and report is not None:
+            report.update(precision_check(lam_input(tensor_lr, data_range), model, attr_objective, gaus_blur_path_func, precision, device=device))
     if data_range != 1.:
         for i in range(len(result_numpy)):
             result_numpy[i] = result_numpy[i] / 2  + 0.5
 
-    grad_numpy, result = saliency_map(interpolated_grad_numpy, result_numpy)
-    model_abs_normed_grad_numpy = grad_abs_norm(grad_numpy)
-    saliency_image_abs = vis_saliency(model_abs_normed_grad_numpy, zoomin=4)
-    saliency_image_kde = vis_saliency_kde(model_abs_normed_grad_numpy)
-    blend_abs_and_input = cv2_to_pil(pil_to_cv2(saliency_image_abs) * (1.0 - alpha) + pil_to_cv2(img_lr.resize(img_hr.size)) * alpha)
-    blend_kde_and_input = cv2_to_pil(pil_to_cv2(saliency_image_kde) * (1.0 - alpha) + pil_to_cv2(img_lr.resize(img_hr.size)) * alpha)
-    images = [
-        pil_to_byte_stream(saliency_image_abs),
-        pil_to_byte_stream(blend_abs_and_input),
-        pil_to_byte_stream(blend_kde_and_input),
-        pil_to_byte_stream(Tensor2PIL(torch.clamp(torch.from_numpy(result), min=0., max=1.)))
-    ]
+    return saliency_map(interpolated_grad_numpy, result_numpy)
+
+def precision_check(numpy_image, model, attr_objective, path_func, precision, step=None, device=device):
+    """
+    Compare the attribution of one path step under precision with its float32 reference.
+    :param step: index of the sampled path step, the middle one when None
+    :return: dict of precision, step, relativeError (L2, of the attribution) and diffusionIndexDelta (reduced minus reference,
+        None when the reduced attribution is all zero)
+    """
+    path = path_func(np.moveaxis(numpy_image, 0, 2))
+    # A PathSteps has one entry per step, an in-memory or memory-mapped path is the (images, lambda_derivatives) pair
+    fold = len(path) if isinstance(path, PathSteps) else len(path[0])
+    step = fold // 2 if step is None else step
+    images, lambda_derivatives = next(itertools.islice(iter_path_batches(path), step, None))
+    def step_path_func(cv_numpy_image):
+        return images, lambda_derivatives
 
+    reference, reduced = [Path_gradient(numpy_image, model, attr_objective, step_path_func, device=device, precision=p)[0][0]
+                          for p in (None, precision)]
+    norm = np.linalg.norm(reference)
+    if norm > 0:
+        relative_error = float(np.linalg.norm(reduced - reference) / norm)
+        # An all-zero attribution has no diffusion index, and NaN is not valid in data.json
+        di_delta = (float(get_diffusion_index(grad_abs_norm(reduced)) - get_diffusion_index(grad_abs_norm(reference)))
+                    if np.any(reduced.sum(axis=0)) else None)
+    else:
+        relative_error = di_delta = 0.
+    return {'precision': precision, 'step': step, 'relativeError': relative_error, 'diffusionIndexDelta': di_delta}
+
+LAM_FORMATS = ('png', 'webp', 'raw')
+RAW_DTYPES = ('float16', 'uint8')
+def check_encoding(fmt='png', compression=None, raw_dtype='float16'):
+    """
+    Raise ValueError for a response encoding iter_render_lam cannot produce, so requests fail before computing LAM.
+    """
+    if fmt not in LAM_FORMATS:
+        raise ValueError(f'Unknown format {fmt}, expected one of {LAM_FORMATS}')
+    if raw_dtype not in RAW_DTYPES:
+        raise ValueError(f'Unknown raw dtype {raw_dtype}, expected one of {RAW_DTYPES}')
+    if compression is not None and not 0 <= compression <= 9:
+        raise ValueError(f'PNG compression level {compression} outside 0-9')
+
+encode_executor = ThreadPoolExecutor(int(os.environ.get('LAM_ENCODE_WORKERS', 4)))
+def encode_image(cv_image, fmt='png', compression=None):
+    """
+    :param fmt: 'png' or 'webp' (lossless)
+    :param compression: PNG zlib level 0-9, OpenCV's default when None
+    :return: encoded bytes
+    """
+    if fmt == 'webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, 101]
+    else:
+        params = [cv2.IMWRITE_PNG_COMPRESSION, int(compression)] if compression is not None else []
+    ok, img_encoded = cv2.imencode(f'.{fmt}', cv_image, params)
+    if not ok:
+        raise RuntimeError(f'Could not encode image as {fmt}')
+    return img_encoded.tobytes()
+
+def encode_array(array, dtype='float16'):
+    """
+    :param array: values in [0, 1]
+    :param dtype: 'float16', or 'uint8' for the values scaled to 0-255
+    :return: .npy bytes
+    """
+    if dtype not in RAW_DTYPES:
+        raise ValueError(f'Unknown raw dtype {dtype}, expected one of {RAW_DTYPES}')
+    if dtype == 'uint8':
+        array = np.rint(array * 255)
     memory_file = BytesIO()
-    with zipfile.ZipFile(memory_file, 'w') as zf:
-        zf.writestr('image_abs.png', images[0].getvalue())
-        zf.writestr('blend_abs.png', images[1].getvalue())
-        zf.writestr('blend_kde.png', images[2].getvalue())
-        zf.writestr('tensor.png', images[3].getvalue())
+    np.save(memory_file, array.astype(dtype))
+    return memory_file.getbuffer()
+
+def iter_render_lam(grad_numpy, result, img_lr, img_hr, alpha=0.5, fmt='png', compression=None, raw_dtype='float16', info=None):
+    """
+    Render the saliency maps, blends, SR output and diffusion index of a LAM result, encoding them in parallel.
+    :param fmt: 'png', 'webp' (lossless) or 'raw' for the LR attribution only, as attribution.npy
+    :param compression: PNG compression level 0-9
+    :param raw_dtype: dtype of attribution.npy, 'float16' or 'uint8'
+    :param info: extra fields of data.json
+    :return: generator of (name, bytes), data.json first, then every image as soon as it is encoded
+    """
+    check_encoding(fmt, compression, raw_dtype)
+    model_abs_normed_grad_numpy = grad_abs_norm(grad_numpy)
+    members = {}
+    if fmt == 'raw':
+        members[encode_executor.submit(encode_array, model_abs_normed_grad_numpy, raw_dtype)] = 'attribution.npy'
+    else:
+        # The bicubic input is shared by both blends.
+        input_image = pil_to_cv2(img_lr.resize(img_hr.size))
+        def render_kde():
+            saliency_image_kde = apply_colormap(saliency_kde(model_abs_normed_grad_numpy) * 0.5 + 0.5, zoomin=4, interpolation='bicubic', bgr=True)
+            return encode_image(blend(saliency_image_kde, input_image, alpha), fmt, compression)
+
+        saliency_image_abs = apply_colormap(model_abs_normed_grad_numpy * 0.5 + 0.5, zoomin=4, bgr=True)
+        result_image = cv2.cvtColor((np.clip(result[0], 0., 1.) * 255).round().astype(np.uint8).transpose(1, 2, 0), cv2.COLOR_RGB2BGR)
+        members[encode_executor.submit(encode_image, saliency_image_abs, fmt, compression)] = f'image_abs.{fmt}'
+        members[encode_executor.submit(lambda: encode_image(blend(saliency_image_abs, input_image, alpha), fmt, compression))] = f'blend_abs.{fmt}'
+        members[encode_executor.submit(render_kde)] = f'blend_kde.{fmt}'
+        members[encode_executor.submit(encode_image, result_image, fmt, compression)] = f'tensor.{fmt}'
+    try:
         di = get_diffusion_index(model_abs_normed_grad_numpy)
-        zf.writestr('data.json', json.dumps({"diffusionIndex": di}))
+        yield 'data.json', json.dumps({"diffusionIndex": di, "format": fmt, **(info or {})}).encode('utf-8')
+        for member in as_completed(members):
+            yield members[member], member.result()
+    finally:
+        for member in members:
+            member.cancel()
+
+def pack_lam(members):
+    """
+    :param members: (name, bytes) of a LAM result, as produced by iter_render_lam
+    :return: zip file stream, stored without compression, with the member sizes added to data.json as payloadBytes
+    """
+    memory_file = BytesIO()
+    payload_bytes = {}
+    with zipfile.ZipFile(memory_file, 'w', compression=zipfile.ZIP_STORED) as zf:
+        for name, data in members:
+            if name == 'data.json':
+                info = json.loads(data)
+                continue
+            zf.writestr(name, data)
+            payload_bytes[name] = len(data)
+        info['payloadBytes'] = payload_bytes
+        zf.writestr('data.json', json.dumps(info))
 
     memory_file.seek(0)
     return memory_file
+
+def unpack_lam(zip_bytes):
+    """
+    :return: generator of the (name, bytes) members of a LAM result zip, data.json first
+    """
+    with zipfile.ZipFile(BytesIO(zip_bytes)) as zf:
+        names = sorted(zf.namelist(), key=lambda name: name != 'data.json')
+        for name in names:
+            yield name, zf.read(name)
+
+def render_lam(grad_numpy, result, img_lr, img_hr, alpha=0.5, fmt='png', compression=None, raw_dtype='float16', info=None):
+    """
+    :return: zip file stream of iter_render_lam
+    """
+    return pack_lam(iter_render_lam(grad_numpy, result, img_lr, img_hr, alpha=alpha, fmt=fmt, compression=compression, raw_dtype=raw_dtype,
+                                    info=info))
+
+def stream_lam_result(compute, img_lr, img_hr, result_key=None, alpha=0.5, fmt='png', compression=None, raw_dtype='float16'):
+    """
+    Stream the members of a LAM result from the result store, or compute, render and store it.
+    :param compute: callable returning grad_numpy, result and extra data.json fields, only called when result_key misses the result store
+    :return: generator of (name, bytes), data.json first
+    """
+    if result_key is not None:
+        cached = result_store.get(result_key)
+        if cached is not None:
+            yield from unpack_lam(cached)
+            return
+    grad_numpy, result, info = compute()
+    members = []
+    for name, data in iter_render_lam(grad_numpy, result, img_lr, img_hr, alpha=alpha, fmt=fmt, compression=compression, raw_dtype=raw_dtype,
+                                      info=info):
+        members.append((name, data))
+        yield name, data
+    if result_key is not None:
+        result_store.put(result_key, pack_lam(members).getbuffer())
+
+def cal_lam(model, tensor_lr, img_lr, img_hr, h, w, window_size, data_range=1., batch_size=1, path_func=None, cancel_event=None,
+            result_key=None, sigma=1.2, fold=50, l=9, alpha=0.5, crop_rf=False, fmt='png', compression=None, raw_dtype='float16',
+            precision=None, checkpoint_every=None):
+    """
+    :param model: network, or a callable returning it that is only called when result_key misses the result store
+    :param result_key: lam_result_key of this request, serves and fills the on-disk result store
+    :param fmt, compression, raw_dtype: response encoding, see iter_render_lam
+    :param precision: 'bf16' or 'fp16' autocast, data.json then reports its precision_check
+    :param checkpoint_every: activation checkpointing of the model body, see compute_lam
+    :return: zip file stream
+    """
+    return pack_lam(stream_lam(model, tensor_lr, img_lr, img_hr, h, w, window_size, data_range=data_range, batch_size=batch_size,
+                               path_func=path_func, cancel_event=cancel_event, result_key=result_key, sigma=sigma, fold=fold, l=l, alpha=alpha,
+                               crop_rf=crop_rf, fmt=fmt, compression=compression, raw_dtype=raw_dtype, precision=precision,
+                               checkpoint_every=checkpoint_every))
+
+def stream_lam(model, tensor_lr, img_lr, img_hr, h, w, window_size, data_range=1., batch_size=1, path_func=None, cancel_event=None,
+               result_key=None, sigma=1.2, fold=50, l=9, alpha=0.5, crop_rf=False, fmt='png', compression=None, raw_dtype='float16',
+               precision=None, checkpoint_every=None):
+    """
+    Same as cal_lam, yielding the members one by one instead of the zip.
+    :return: generator of (name, bytes), data.json first, then every image as soon as it is encoded
+    """
+    check_encoding(fmt, compression, raw_dtype)
+    def compute():
+        bare_model = model if isinstance(model, torch.nn.Module) else model()
+        report = {}
+        grad_numpy, result = compute_lam(bare_model, tensor_lr, h, w, window_size, data_range=data_range, batch_size=batch_size,
+                                         path_func=path_func, cancel_event=cancel_event, sigma=sigma, fold=fold, l=l, crop_rf=crop_rf,
+                                         precision=precision, report=report, checkpoint_every=checkpoint_every)
+        return grad_numpy, result, {'precisionCheck': report} if report else None
+
+    return stream_lam_result(compute, img_lr, img_hr, result_key=result_key, alpha=alpha, fmt=fmt, compression=compression, raw_dtype=raw_dtype)
@@ -1,18 +1,27 @@
 import os
 import re
-import io
 import sys
 import glob
 import math
+import random
+import hashlib
+import json
 from os import path as osp
 from basicsr.train import build_model
-from contextlib import contextmanager
-from basicsr.utils.options import parse_options
+from basicsr.utils.options import ordered_yaml
+from basicsr.utils.dist_util import get_dist_info
 import traceback
 import basicsr
 import yaml
+import torch
+from cache import LRUCache
+from results_index import ResultsIndex
+from ModelZoo.checkpoints import load_converted
+from SaliencyModel.BackProp import get_device
 
 root_path = osp.dirname(osp.dirname(basicsr.__file__))
+# Same device as lam.compute_lam runs on
+device = get_device(os.environ.get('LAM_DEVICE'))
 sys.path.append(root_path)
 # os.chdir(root_path)
 
@@ -83,77 +92,226 @@ def extract_ymal_string_from_log(filepath):
         return file.read()
 
 def save_dict_as_yaml(parsed_dict, filepath):
-    with open(filepath, 'w') as file:
-        yaml.dump(parsed_dict, file, default_flow_style=False, sort_keys=False)
-
-@contextmanager
-def suppress_stdout():
-    original_stdout = sys.stdout
-    sys.stdout = io.StringIO()
+    """
+    Write parsed_dict to filepath, leaving the file untouched when it already holds the same YAML.
+    """
+    content = yaml.dump(parsed_dict, default_flow_style=False, sort_keys=False)
     try:
-        yield
-    finally:
-        sys.stdout = original_stdout
+        with open(filepath, 'r') as file:
+            if file.read() == content:
+                return
+    except OSError:
+        pass
+    temp = f'{filepath}.{os.getpid()}.tmp'
+    with open(temp, 'w') as file:
+        file.write(content)
+    os.replace(temp, filepath)
+
+results_index = ResultsIndex(os.path.join(root_path, 'results'), index_path=os.environ.get(
+    'LAM_RESULTS_INDEX', osp.expanduser(f"~/.cache/lam/results_index-{hashlib.sha1(root_path.encode('utf-8')).hexdigest()[:12]}.json")))
+results_index.start(float(os.environ.get('LAM_RESULTS_INDEX_INTERVAL', 60)))
 
 def get_logs():
-    results_path = os.path.join(root_path, 'results')
-    log_files = []
-    for dirpath, dirnames, filenames in os.walk(results_path):
-        sorted_logs = sorted([file for file in filenames if file.endswith('.log')])
-        if sorted_logs:
-            log_files.append(os.path.join(dirpath, sorted_logs[-1]))
-        if sorted_logs:
-            dirnames.clear()
-    return log_files
-
-logs = get_logs()
+    return results_index.logs()
+
 def get_model_log(path):
-    global logs
-    for log in logs:
-        if osp.dirname(log).endswith(path):
-            return log
-    logs = get_logs()
-    for log in logs:
-        if osp.dirname(log).endswith(path):
-            return log
+    experiment = results_index.find(path)
+    if experiment is None:
+        results_index.refresh()
+        experiment = results_index.find(path)
+    if experiment is not None:
+        return experiment['log']
 
 
+log_timestamp_pattern = re.compile(r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3}")
+log_block_pattern = re.compile(log_timestamp_pattern.pattern + r" INFO: \n")
 def extract_yaml_from_log(log_path):
+    """
+    Return the first INFO block of a BasicSR training log that holds the options (has a "name: " line).
+    The log is read line by line and only up to the end of that block.
+    """
+    block = None
     with open(log_path, 'r') as file:
-        log_content = file.read()
+        for line in file:
+            if block is not None:
+                timestamp = log_timestamp_pattern.search(line)
+                if timestamp is None:
+                    block.append(line)
+                    continue
+                block.append(line[:timestamp.start()])
+                match = ''.join(block)
+                if "name: " in match:
+                    return match
+                block = None
+                line = line[timestamp.start():]
+            if log_block_pattern.search(line):
+                block = []
 
-    pattern = r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2},\d{3} INFO: \n([\s\S]*?)(?=\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2})"
-    matches = re.findall(pattern, log_content)
 
-    for match in matches:
-        if "name: " in match:
-            return match
+log_options_cache = LRUCache(256)
+def get_log_options(log_path):
+    """
+    Options of a training log, parsed once per log version.
+    :return: options dict (shared between callers, do not modify in place)
+    """
+    stat = os.stat(log_path)
+    return log_options_cache.get_or_create((osp.realpath(log_path), stat.st_mtime_ns), lambda: str2dict(extract_yaml_from_log(log_path)))
 
-argv = sys.argv.copy()
-def get_model(opt_path):
-    original_path = os.getcwd()
-    os.chdir(root_path)
+def resolve_path(path):
+    path = osp.expanduser(path)
+    return path if osp.isabs(path) else osp.join(root_path, path)
+
+def parse_options_file(opt_path):
+    """
+    basicsr parse_options(root_path, is_train=False) for an explicit option file.
+    Unlike it, this leaves sys.argv, the working directory, stdout and the random seeds alone, so it is thread-safe.
+    Relative paths, in opt_path and in the options, are resolved against root_path.
+    """
+    with open(resolve_path(opt_path), mode='r') as f:
+        opt = yaml.load(f, Loader=ordered_yaml()[0])
+
+    opt['dist'] = False
+    opt['rank'], opt['world_size'] = get_dist_info()
+    if opt.get('manual_seed') is None:
+        opt['manual_seed'] = random.randint(1, 10000)
+    opt['auto_resume'] = False
+    opt['is_train'] = False
+
+    if opt.get('num_gpu') == 'auto':
+        opt['num_gpu'] = torch.cuda.device_count()
+    # BaseModel moves the networks to CUDA whenever num_gpu is not 0, as training options usually ask.
+    if device.type == 'cpu':
+        opt['num_gpu'] = 0
+
+    for phase, dataset in opt.get('datasets', {}).items():
+        phase = phase.split('_')[0]
+        dataset['phase'] = phase
+        if 'scale' in opt:
+            dataset['scale'] = opt['scale']
+        for key in ('dataroot_gt', 'dataroot_lq'):
+            if dataset.get(key) is not None:
+                dataset[key] = resolve_path(dataset[key])
 
-    sys.argv = [argv[0], '-opt', opt_path]
+    for key, val in opt['path'].items():
+        if (val is not None) and ('resume_state' in key or 'pretrain_network' in key):
+            opt['path'][key] = resolve_path(val)
 
-    opt, args = None, None
-    with suppress_stdout():
-        opt, args = parse_options(root_path, False)
+    results_root = osp.join(root_path, 'results', opt['name'])
+    opt['path']['results_root'] = results_root
+    opt['path']['log'] = results_root
+    opt['path']['visualization'] = osp.join(results_root, 'visualization')
     opt['root_path'] = root_path
+    return opt
 
+def get_model(opt_path):
     model = None
     try:
+        opt = parse_options_file(opt_path)
+        # Build without weights, then load net_g through the converted checkpoint cache.
+        load_path = opt['path'].get('pretrain_network_g')
+        opt['path']['pretrain_network_g'] = None
         model = build_model(opt)
     except Exception as error:
         print(opt_path, 'build_model error.', error)
         traceback.print_exc()
+        return None
+    # Outside the try: a failed weight load must fail the request, not serve the untrained network.
+    if load_path is not None:
+        net = model.get_bare_model(model.net_g)
+        strict, param_key = opt['path'].get('strict_load_g', True), opt['path'].get('param_key_g', 'params')
+        load_converted(net, load_path, lambda: model.load_network(net, load_path, strict, param_key),
+                       identity={'strict': strict, 'param_key': param_key})
+        opt['path']['pretrain_network_g'] = load_path
     # net = model.get_bare_model(model.net_g)
     # parameters = sum(map(lambda x: x.numel(), net.parameters()))
-    os.chdir(original_path)
     return model
 
 def get_model_from_path(path):
     log_path = get_model_log(path)
     yaml_path = log_path + '.yml'
-    save_dict_as_yaml(str2dict(extract_yaml_from_log(log_path)), yaml_path)
+    save_dict_as_yaml(get_log_options(log_path), yaml_path)
     return get_model(yaml_path)
+
+
+def is_option_file(path):
+    return path.endswith('.yml') or path.endswith('.yaml')
+
+
+def get_checkpoint_path(opt):
+    checkpoint_path = opt.get('path', {}).get('pretrain_network_g')
+    if checkpoint_path is None:
+        return None
+    return osp.realpath(resolve_path(checkpoint_path))
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+
+
+def get_options(path):
+    """
+    :param path: option file (.yml/.yaml) or experiment path resolved through the results logs
+    :return: (option source, options) of a viewer path, without parsing them for a build
+    """
+    if is_option_file(path):
+        opt_path = osp.realpath(resolve_path(path))
+        with open(opt_path, 'r') as file:
+            return opt_path, yaml.safe_load(file)
+    opt_path = get_model_log(path)
+    if opt_path is None:
+        raise FileNotFoundError(f'No training log found for {path}')
+    opt_path = osp.realpath(opt_path)
+    return opt_path, get_log_options(opt_path)
+
+
+def get_model_key(path):
+    """
+    Identify the network behind a viewer path without building it.
+    :return: (option source, option mtime, checkpoint path, checkpoint mtime)
+    """
+    opt_path, opt = get_options(path)
+    checkpoint_path = get_checkpoint_path(opt)
+    return opt_path, get_mtime(opt_path), checkpoint_path, get_mtime(checkpoint_path)
+
+
+def options_digest(opt):
+    """
+    Digest of the options that decide which network a checkpoint is loaded into, and which of its weights.
+    """
+    path_opt = opt.get('path') or {}
+    identity = {
+        'network_g': opt.get('network_g'),
+        'param_key_g': path_opt.get('param_key_g', 'params'),
+        'strict_load_g': path_opt.get('strict_load_g', True),
+    }
+    return hashlib.sha256(json.dumps(identity, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def get_model_options(path):
+    """
+    :return: options_digest of the network behind a viewer path, to tell apart models sharing a checkpoint
+    """
+    return options_digest(get_options(path)[1])
+
+
+def module_nbytes(net):
+    tensors = list(net.parameters()) + list(net.buffers())
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors)
+
+
+model_cache = LRUCache(int(os.environ.get('LAM_MODEL_CACHE_BYTES', 4 * 1024 ** 3)), sizeof=module_nbytes)
+def get_bare_model(path):
+    """
+    Return the resident bare net_g for path, building it on a cache miss.
+    Entries are keyed by get_model_key, so retraining or editing the options invalidates them.
+    """
+    def build():
+        model = get_model(path) if is_option_file(path) else get_model_from_path(path)
+        if model is None:
+            raise RuntimeError(f'Failed to build model for {path}')
+        return model.get_bare_model(model.net_g)
+
+    return model_cache.get_or_create(get_model_key(path), build)
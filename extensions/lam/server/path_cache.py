@@ -0,0 +1,127 @@
+import os
+import hashlib
+import threading
+import numpy as np
+from os import path as osp
+from cache import LRUCache, DiskLRU
+
+
+def path_nbytes(path):
+    return sum(array.nbytes for array in path)
+
+
+class PathCache:
+    """
+    Interpolation paths (image and lambda-derivative stacks) keyed by image content and path parameters.
+    Entries live in RAM and, with a spill directory, are written there as float16 when evicted.
+    :param capacity: maximum bytes held in RAM
+    :param spill_dir: directory for evicted paths, None to drop them
+    :param spill_capacity: maximum bytes in spill_dir, least recently used paths are deleted first, None for no bound
+    """
+
+    def __init__(self, capacity, spill_dir=None, spill_capacity=None):
+        self.memory = LRUCache(capacity, sizeof=path_nbytes, on_evict=self.spill)
+        self.spill_dir = spill_dir
+        self.spill_hits = 0
+        self.spilled = DiskLRU(spill_dir, spill_capacity) if spill_dir is not None else None
+
+    @staticmethod
+    def make_key(cv_numpy_image, *params):
+        digest = hashlib.sha256(np.ascontiguousarray(cv_numpy_image).tobytes()).hexdigest()
+        return digest, cv_numpy_image.shape, str(cv_numpy_image.dtype), params
+
+    def spill_path(self, key):
+        return osp.join(self.spill_dir, hashlib.sha256(repr(key).encode('utf-8')).hexdigest() + '.npz')
+
+    def spill(self, key, path):
+        if self.spill_dir is None:
+            return
+        target = self.spill_path(key)
+        if osp.exists(target):
+            self.spilled.touch(target)
+            return
+        temp = f'{target}.{os.getpid()}.tmp'
+        with open(temp, 'wb') as file:
+            np.savez(file, *[array.astype(np.float16) for array in path])
+        os.replace(temp, target)
+        self.spilled.add(target)
+
+    def load_spilled(self, key):
+        if self.spill_dir is None:
+            return None
+        target = self.spill_path(key)
+        try:
+            with np.load(target) as spilled:
+                path = tuple(spilled[f'arr_{i}'].astype(np.float32) for i in range(len(spilled.files)))
+        except OSError:
+            return None
+        self.spilled.touch(target)
+        return path
+
+    def get_or_create(self, key, factory):
+        """
+        :return: the path for key, shared between callers (do not modify in place)
+        """
+        def load_or_build():
+            path = self.load_spilled(key)
+            if path is not None:
+                self.spill_hits += 1
+                return path
+            return factory()
+
+        return self.memory.get_or_create(key, load_or_build)
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats['spill_hits'] = self.spill_hits
+        if self.spilled is not None:
+            stats['spill_size'] = self.spilled.size
+            stats['spill_evictions'] = self.spilled.evictions
+        return stats
+
+
+def CachedPath(path_cache, path_func, *params):
+    """
+    Wrap path_func so its output is served from path_cache.
+    :param params: everything besides the image that path_func depends on, e.g. ('gaussian_blur', sigma, fold, l)
+    """
+    def path_interpolation_func(cv_numpy_image):
+        key = path_cache.make_key(cv_numpy_image, *params)
+        return path_cache.get_or_create(key, lambda: path_func(cv_numpy_image))
+    return path_interpolation_func
+
+
+def MemmapPath(path_func, disk, *params):
+    """
+    Wrap a lazy path_func (returning PathSteps) so its steps are written once to .npy files in a directory
+    and served memory-mapped, paged in as Path_gradient reads each micro-batch.
+    :param disk: DiskLRU of the directory, shared between the wrapped functions so its bound holds for all of them
+    :param params: everything besides the image that path_func depends on
+    """
+    def path_interpolation_func(cv_numpy_image):
+        digest = hashlib.sha256(repr(PathCache.make_key(cv_numpy_image, *params)).encode('utf-8')).hexdigest()
+        targets = [osp.join(disk.directory, f'{digest}.{name}.npy') for name in ('images', 'lambda_derivatives')]
+        written = not all(osp.exists(target) for target in targets)
+        if written:
+            path = path_func(cv_numpy_image)
+            temps = [f'{target}.{os.getpid()}.{threading.get_ident()}.tmp' for target in targets]
+            arrays = None
+            for i, step in enumerate(path):
+                if arrays is None:
+                    arrays = [np.lib.format.open_memmap(temp, mode='w+', dtype=np.float32, shape=(len(path),) + array.shape)
+                              for temp, array in zip(temps, step)]
+                for array, value in zip(arrays, step):
+                    array[i] = value
+            for array in arrays:
+                array.flush()
+            del arrays
+            for temp, target in zip(temps, targets):
+                os.replace(temp, target)
+        else:
+            disk.touch(*targets)
+        # Mapped before any eviction, which only unlinks the files under an open map.
+        path = tuple(np.load(target, mmap_mode='r') for target in targets)
+        if written:
+            disk.add(*targets)
+        return path
+    return path_interpolation_func
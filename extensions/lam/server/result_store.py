@@ -0,0 +1,123 @@
+import os
+import json
+import hashlib
+import threading
+from os import path as osp
+from cache import LRUCache
+
+
+def file_digest(path, chunk_size=1024 ** 2):
+    with open(path, 'rb') as file:
+        digest = hashlib.sha256()
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+digest_cache = LRUCache(1024)
+def cached_file_digest(path):
+    """
+    sha256 of a file's bytes, recomputed only when its size or mtime changes.
+    """
+    stat = os.stat(path)
+    return digest_cache.get_or_create((osp.realpath(path), stat.st_size, stat.st_mtime_ns), lambda: file_digest(path))
+
+
+class ResultStore:
+    """
+    Content-addressed on-disk store of LAM results (<key>.zip, the response zip), evicted least recently used first.
+    Entries of older stores may also hold a float16 attribution (<key>.npy), counted and deleted with their zip.
+    :param root: store directory
+    :param capacity: maximum total bytes on disk
+    """
+
+    def __init__(self, root, capacity):
+        self.root = root
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.size = sum(size for _, _, size in self.scan())
+
+    @staticmethod
+    def make_key(checkpoint_path, image_path, **params):
+        identity = {
+            'checkpoint': cached_file_digest(checkpoint_path) if checkpoint_path else None,
+            'image': cached_file_digest(image_path),
+            'params': params,
+        }
+        return hashlib.sha256(json.dumps(identity, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def entry_path(self, key, ext):
+        return osp.join(self.root, key[:2], f'{key}.{ext}')
+
+    def scan(self):
+        """
+        :return: list of (mtime, key, bytes) for every complete entry
+        """
+        entries = []
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.endswith('.zip'):
+                    key = filename[:-4]
+                    size = 0
+                    for ext in ('zip', 'npy'):
+                        try:
+                            size += os.stat(self.entry_path(key, ext)).st_size
+                        except OSError:
+                            pass
+                    entries.append((os.stat(osp.join(dirpath, filename)).st_mtime, key, size))
+        return entries
+
+    def get(self, key):
+        zip_path = self.entry_path(key, 'zip')
+        try:
+            with open(zip_path, 'rb') as file:
+                data = file.read()
+            os.utime(zip_path)
+        except OSError:
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, zip_bytes):
+        target = self.entry_path(key, 'zip')
+        os.makedirs(osp.dirname(target), exist_ok=True)
+        temp = f'{target}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temp, 'wb') as file:
+            file.write(zip_bytes)
+        size = os.stat(temp).st_size
+        os.replace(temp, target)
+        with self.lock:
+            self.size += size
+            if self.size > self.capacity:
+                self.evict()
+
+    def evict(self):
+        entries = sorted(self.scan())
+        self.size = sum(size for _, _, size in entries)
+        for _, key, size in entries:
+            if self.size <= self.capacity:
+                break
+            for ext in ('zip', 'npy'):
+                try:
+                    os.remove(self.entry_path(key, ext))
+                except OSError:
+                    pass
+            self.size -= size
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': self.size,
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import threading
+from os import path as osp
+
+
+def get_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def scan_checkpoints(models_path):
+    """
+    :return: {file name: mtime} of the .pth files in a BasicSR models directory
+    """
+    checkpoints = {}
+    try:
+        with os.scandir(models_path) as entries:
+            for entry in entries:
+                if entry.name.endswith('.pth') and entry.is_file():
+                    checkpoints[entry.name] = entry.stat().st_mtime_ns
+    except OSError:
+        pass
+    return checkpoints
+
+
+class ResultsIndex:
+    """
+    Persistent index of the experiments under a BasicSR results directory.
+    An experiment is a directory holding training logs; directories without logs are searched for experiments.
+    Refreshes only rescan directories whose mtime changed, and run in a background thread once started.
+    :param root: results directory
+    :param index_path: JSON file the index is kept in between runs, None to keep it in memory only
+    """
+
+    version = 1
+
+    def __init__(self, root, index_path=None):
+        self.root = root
+        self.index_path = index_path
+        self.dirs = {}
+        self.experiments = {}
+        self.by_name = {}
+        self.refreshes = 0
+        self.refresh_seconds = None
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.thread = None
+        self.load()
+
+    def load(self):
+        if self.index_path is None:
+            return
+        try:
+            with open(self.index_path, 'r') as file:
+                index = json.load(file)
+        except (OSError, ValueError):
+            return
+        if index.get('version') == self.version and index.get('root') == self.root:
+            self.publish(index['dirs'], index['experiments'])
+
+    def save(self):
+        if self.index_path is None:
+            return
+        os.makedirs(osp.dirname(self.index_path), exist_ok=True)
+        temp = f'{self.index_path}.{os.getpid()}.tmp'
+        with open(temp, 'w') as file:
+            json.dump({'version': self.version, 'root': self.root, 'dirs': self.dirs, 'experiments': self.experiments}, file)
+        os.replace(temp, self.index_path)
+
+    def publish(self, dirs, experiments):
+        by_name = {}
+        for relative_path in experiments:
+            by_name.setdefault(osp.basename(relative_path), []).append(relative_path)
+        with self.lock:
+            self.dirs, self.experiments, self.by_name = dirs, experiments, by_name
+
+    def scan_dir(self, relative_path, mtime):
+        """
+        List one directory.
+        :return: its dirs entry, and its experiment entry when it holds logs
+        """
+        full_path = osp.join(self.root, relative_path)
+        subdirs, logs, options = [], [], []
+        with os.scandir(full_path) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.name.endswith('.log'):
+                    logs.append(entry.name)
+                elif entry.name.endswith('.yml') or entry.name.endswith('.yaml'):
+                    options.append(entry.name)
+        if not logs:
+            return {'mtime': mtime, 'children': sorted(osp.join(relative_path, name) for name in subdirs)}, None
+
+        log = osp.join(full_path, max(logs))
+        models_path = osp.join(full_path, 'models')
+        experiment = {
+            'log': log,
+            'log_mtime': os.stat(log).st_mtime_ns,
+            'options': sorted(osp.join(full_path, name) for name in options),
+            'models_mtime': get_mtime(models_path),
+            'checkpoints': scan_checkpoints(models_path),
+        }
+        return {'mtime': mtime, 'children': []}, experiment
+
+    def refresh(self):
+        """
+        Bring the index up to date, rescanning only the directories whose mtime changed.
+        :return: True when anything changed
+        """
+        with self.refresh_lock:
+            start = time.time()
+            with self.lock:
+                old_dirs, old_experiments = self.dirs, self.experiments
+            dirs, experiments = {}, {}
+            changed = False
+            stack = ['']
+            while stack:
+                relative_path = stack.pop()
+                full_path = osp.join(self.root, relative_path)
+                mtime = get_mtime(full_path)
+                if mtime is None:
+                    changed = True
+                    continue
+                known = old_dirs.get(relative_path)
+                experiment = old_experiments.get(relative_path)
+                # New checkpoints land in models/, which does not touch the mtime of the experiment directory.
+                if known is not None and known['mtime'] == mtime and \
+                        (experiment is None or experiment['models_mtime'] == get_mtime(osp.join(full_path, 'models'))):
+                    entry = known
+                else:
+                    try:
+                        entry, experiment = self.scan_dir(relative_path, mtime)
+                    except OSError:
+                        changed = True
+                        continue
+                    changed = True
+                dirs[relative_path] = entry
+                if experiment is not None:
+                    experiments[relative_path] = experiment
+                stack.extend(entry['children'])
+            changed = changed or dirs.keys() != old_dirs.keys()
+            if changed:
+                self.publish(dirs, experiments)
+                self.save()
+            self.refreshes += 1
+            self.refresh_seconds = time.time() - start
+            return changed
+
+    def find(self, path):
+        """
+        :param path: experiment directory, or any trailing part of it such as the experiment name
+        :return: experiment entry (log, log_mtime, options, models_mtime, checkpoints), None when unknown
+        """
+        path = osp.normpath(path)
+        with self.lock:
+            candidates = sorted(self.by_name.get(osp.basename(path), ()))
+            for relative_path in candidates:
+                if osp.join(self.root, relative_path).endswith(path):
+                    return self.experiments[relative_path]
+        return None
+
+    def logs(self):
+        with self.lock:
+            return [experiment['log'] for experiment in self.experiments.values()]
+
+    def start(self, interval=60.):
+        """
+        Refresh now and then every interval seconds in a daemon thread.
+        """
+        def run():
+            while True:
+                try:
+                    self.refresh()
+                except Exception as error:
+                    print('results index refresh error.', error)
+                time.sleep(interval)
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=run, name='results-index', daemon=True)
+            self.thread.start()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'experiments': len(self.experiments),
+                'dirs': len(self.dirs),
+                'refreshes': self.refreshes,
+                'refresh_seconds': self.refresh_seconds,
+            }
@@ -1,13 +1,103 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, send_file, Response, stream_with_context
 from flask_cors import CORS
-from lam import get_position_image, load_img, cal_lam
-from model_loader import get_model_from_path, get_root_path, get_model
+from lam import get_position_image, load_img, check_encoding, cal_lam, stream_lam, stream_lam_result, pack_lam, unpack_lam, image_cache, path_cache, lam_result_key, result_store
+from model_loader import get_root_path, get_bare_model, get_model_key, get_model_options, model_cache, results_index
+from jobs import JobManager
+from sessions import LAMSession, SessionManager, SessionTooLarge
+from atlas import atlas_path, build_atlas, find_atlas, atlas_disk
+from worker_pool import LAMWorkerPool
+from SaliencyModel.BackProp import PathGradientCancelled
 import traceback
+import os
+import json
+import base64
+import mimetypes
+from functools import partial
+from io import BytesIO
 
 app = Flask(__name__)
 CORS(app)
 
 root_path = get_root_path()
+default_batch_size = int(os.environ.get('LAM_BATCH_SIZE', 1))
+job_manager = JobManager(max_workers=int(os.environ.get('LAM_JOB_WORKERS', 1)), ttl=int(os.environ.get('LAM_JOB_TTL', 600)))
+session_manager = SessionManager(int(os.environ.get('LAM_SESSION_BYTES', 8 * 1024 ** 3)), ttl=int(os.environ.get('LAM_SESSION_TTL', 300)))
+worker_pool = None
+
+def get_lam_paths(data):
+    return data.get('paths') if data.get('type') == 'lam_multi' else [data.get('path')]
+
+def get_encoding(data):
+    """
+    Response encoding of a request: format ('png', 'webp' or 'raw'), PNG compression level and raw attribution dtype.
+    Raises ValueError for an encoding that cannot be rendered.
+    """
+    compression = data.get('compression')
+    encoding = {
+        'fmt': data.get('format', 'png'),
+        'compression': int(compression) if compression is not None else None,
+        'raw_dtype': data.get('raw_dtype', 'float16'),
+    }
+    check_encoding(**encoding)
+    return encoding
+
+def get_batch_options(data):
+    """
+    Micro-batch size and activation checkpointing of a request, see compute_lam.
+    Raises ValueError for values the path loop cannot run with, so requests fail before any model work.
+    :return: batch_size, checkpoint_every
+    """
+    batch_size = int(data.get('batch_size', default_batch_size))
+    checkpoint_every = data.get('checkpoint_every')
+    checkpoint_every = int(checkpoint_every) if checkpoint_every is not None else None
+    if batch_size < 1:
+        raise ValueError(f'batch_size {batch_size} must be at least 1')
+    if checkpoint_every is not None and checkpoint_every < 0:
+        raise ValueError(f'checkpoint_every {checkpoint_every} must not be negative')
+    return batch_size, checkpoint_every
+
+def iter_lam(data, cancel_event=None, stream=False):
+    """
+    Run LAM for every model of a lam/lam_multi request, sharing the image and blur path through their caches.
+    :param stream: give the (name, bytes) member generator of stream_lam instead of the zip file
+    :return: generator of (index, path, zip_file, error)
+    """
+    img_path = f"{root_path}/{data.get('file')}"
+    img_lr, img_hr, tensor_lr = load_img(img_path)
+    x, y, w = data.get('x'), data.get('y'), data.get('w')
+    batch_size, checkpoint_every = get_batch_options(data)
+    crop_rf = bool(data.get('crop', False))
+    precision = data.get('precision')
+    encoding = get_encoding(data)
+    paths = get_lam_paths(data)
+    for index, path in enumerate(paths):
+        if cancel_event is not None and cancel_event.is_set():
+            raise PathGradientCancelled()
+        try:
+            opt_path, _, checkpoint_path, _ = get_model_key(path)
+            model_options = get_model_options(path)
+            result_key = lam_result_key(checkpoint_path or opt_path, img_path, y, x, w, data_range=2, crop_rf=crop_rf, precision=precision,
+                                        model_options=model_options, **encoding)
+            atlas_result = None if crop_rf else find_atlas(checkpoint_path or opt_path, img_path, y, x, w, data_range=2, precision=precision,
+                                                           model_options=model_options)
+            if atlas_result is not None:
+                # Grid-aligned window of a precomputed atlas, rendered without touching the model.
+                members = stream_lam_result(lambda: atlas_result, img_lr, img_hr, **encoding)
+                zip_file = members if stream else pack_lam(members)
+            elif worker_pool is not None:
+                zip_file = (worker_pool.stream_lam if stream else worker_pool.cal_lam)(path, img_lr, img_hr, img_path, y, x, w, data_range=2, batch_size=batch_size,
+                                               cancel_event=cancel_event, result_key=result_key, crop_rf=crop_rf, precision=precision,
+                                               checkpoint_every=checkpoint_every, **encoding)
+            else:
+                zip_file = (stream_lam if stream else cal_lam)(partial(get_bare_model, path), tensor_lr, img_lr, img_hr, y, x, w, data_range=2, batch_size=batch_size,
+                                   cancel_event=cancel_event, result_key=result_key, crop_rf=crop_rf, precision=precision,
+                                   checkpoint_every=checkpoint_every, **encoding)
+            yield index, path, zip_file, None
+        except PathGradientCancelled:
+            raise
+        except Exception as e:
+            yield index, path, None, traceback.format_exc()
+
 @app.route('/lam', methods=['POST'])
 def handle_lam():
     data = request.get_json()
@@ -20,22 +110,240 @@ def handle_lam():
     w = data.get('w')
     h = data.get('h')
     print(type, file, path, x, y, w, h)
-    img_lr, img_hr, cv2_lr, cv2_hr, tensor_lr = load_img(f'{root_path}/{file}')
+    if type in ('lam', 'lam_multi', 'lam_stream'):
+        try:
+            get_encoding(data)
+            get_batch_options(data)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    img_lr, img_hr, tensor_lr = load_img(f'{root_path}/{file}')
     if type == 'get_position_image':
         image = get_position_image(img_hr, w, y, x)
         return send_file(image, mimetype='image/png')
     elif type == 'lam':
-        try:
-            if path.endswith('.yml') or path.endswith('.yaml'):
-                model = get_model(path)
-            else:
-                model = get_model_from_path(path)
-            model = model.get_bare_model(model.net_g)
-            zip_file = cal_lam(model, tensor_lr, img_lr, img_hr, y, x, w, data_range=2)
-            return send_file(zip_file, mimetype='application/zip')
-        except Exception as e:
-            stack_trace = traceback.format_exc()
-            return jsonify({'error': stack_trace}), 500
+        _, _, zip_file, error = next(iter_lam(data))
+        if error is not None:
+            return jsonify({'error': error}), 500
+        response = send_file(zip_file, mimetype='application/zip')
+        response.headers['X-LAM-Payload-Bytes'] = str(zip_file.getbuffer().nbytes)
+        return response
+    elif type == 'lam_multi':
+        def generate():
+            # One NDJSON line per model, in order, as soon as its zip is ready.
+            for index, path, zip_file, error in iter_lam(data):
+                if error is None:
+                    zip_bytes = zip_file.getbuffer()
+                    line = {'index': index, 'path': path, 'bytes': zip_bytes.nbytes, 'zip': base64.b64encode(zip_bytes).decode('ascii')}
+                else:
+                    line = {'index': index, 'path': path, 'error': error}
+                yield json.dumps(line) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    elif type == 'lam_stream':
+        def generate():
+            # One NDJSON line per zip member: data.json with the diffusion index first, then every image once encoded.
+            for index, path, members, error in iter_lam(data, stream=True):
+                if error is None:
+                    try:
+                        for name, member in members:
+                            line = {'index': index, 'path': path, 'name': name, 'bytes': len(member), 'data': base64.b64encode(member).decode('ascii')}
+                            yield json.dumps(line) + '\n'
+                    except PathGradientCancelled:
+                        raise
+                    except Exception:
+                        error = traceback.format_exc()
+                if error is not None:
+                    yield json.dumps({'index': index, 'path': path, 'error': error}) + '\n'
+
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+def run_atlas(data, job):
+    """
+    Build the atlas of the model at data['path'] on data['file'] for data['w'] windows every data['stride'] pixels.
+    The job result is a zip of the atlas meta.json (as data.json) and its diffusion index grid and heatmap.
+    """
+    path = data.get('path')
+    img_path = f"{root_path}/{data.get('file')}"
+    window_size = int(data.get('w'))
+    precision = data.get('precision')
+    opt_path, _, checkpoint_path, _ = get_model_key(path)
+    _, _, tensor_lr = load_img(img_path)
+    target = atlas_path(checkpoint_path or opt_path, img_path, window_size, data_range=2, precision=precision,
+                        model_options=get_model_options(path))
+
+    def progress(fraction):
+        job.progress = fraction
+
+    meta = build_atlas(get_bare_model(path), tensor_lr, target, window_size=window_size, stride=int(data.get('stride', window_size // 2)),
+                       data_range=2, batch_size=get_batch_options(data)[0], precision=precision,
+                       cancel_event=job.cancel_event, progress=progress, info={'path': path, 'file': data.get('file')})
+    members = [('data.json', json.dumps(meta).encode('utf-8'))]
+    for name in ('diffusion_index.png', 'diffusion_index.npy'):
+        with open(os.path.join(target, name), 'rb') as file:
+            members.append((name, file.read()))
+    atlas_disk.add(target)
+    job.results[0] = pack_lam(members).getvalue()
+
+@app.route('/lam/jobs', methods=['POST'])
+def submit_job():
+    data = request.get_json()
+    try:
+        get_batch_options(data)
+        if data.get('type') != 'lam_atlas':
+            get_encoding(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if data.get('type') == 'lam_atlas':
+        job = job_manager.submit(partial(run_atlas, data), 1)
+        return jsonify(job.to_dict()), 202
+
+    def run(job):
+        for index, path, members, error in iter_lam(data, cancel_event=job.cancel_event, stream=True):
+            if error is None:
+                # Publish every member as it is rendered, so clients can show the diffusion index before the images.
+                job.members[index] = {}
+                try:
+                    for name, member in members:
+                        job.members[index][name] = member
+                    job.results[index] = pack_lam(job.members[index].items()).getvalue()
+                except PathGradientCancelled:
+                    raise
+                except Exception:
+                    error = traceback.format_exc()
+                finally:
+                    job.members.pop(index, None)
+            if error is not None:
+                job.errors[str(index)] = error
+
+    job = job_manager.submit(run, len(get_lam_paths(data)))
+    return jsonify(job.to_dict()), 202
+
+@app.route('/lam/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/lam/jobs/<job_id>/result/<int:index>', methods=['GET'])
+def get_job_result(job_id, index):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+    if index not in job.results:
+        return jsonify(job.to_dict()), 409
+    return send_file(BytesIO(job.results[index]), mimetype='application/zip')
+
+@app.route('/lam/jobs/<job_id>/result/<int:index>/<name>', methods=['GET'])
+def get_job_result_member(job_id, index, name):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+    if index in job.results:
+        members = dict(unpack_lam(job.results[index]))
+    else:
+        members = job.members.get(index, {})
+    if name not in members:
+        return jsonify(job.to_dict()), 409
+    return send_file(BytesIO(members[name]), mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+
+@app.route('/lam/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = job_manager.cancel(job_id)
+    if job is None:
+        return jsonify({'error': f'Unknown job {job_id}'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/lam/sessions', methods=['POST'])
+def open_session():
+    """
+    Run and keep the forward passes of the model at data['path'] on data['file'], for the window requests of /lam/sessions/<id>.
+    Sessions always compute in the server process, as their graphs cannot leave it.
+    """
+    data = request.get_json()
+    path = data.get('path')
+    img_path = f"{root_path}/{data.get('file')}"
+    try:
+        batch_size, _ = get_batch_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    precision = data.get('precision')
+    try:
+        key = SessionManager.make_key(get_model_key(path), img_path, data_range=2, precision=precision,
+                                      model_options=get_model_options(path))
+
+        def factory(key):
+            _, _, tensor_lr = load_img(img_path)
+            return LAMSession(key, get_bare_model(path), tensor_lr, data_range=2, batch_size=batch_size, precision=precision)
+
+        session = session_manager.open(key, factory)
+    except SessionTooLarge as e:
+        return jsonify({'error': str(e)}), 507
+    except Exception:
+        return jsonify({'error': traceback.format_exc()}), 500
+    return jsonify(session.to_dict()), 201
+
+@app.route('/lam/sessions/<session_id>', methods=['GET'])
+def get_session(session_id):
+    session = session_manager.get(session_id)
+    if session is None:
+        return jsonify({'error': f'Unknown session {session_id}'}), 404
+    return jsonify(session.to_dict())
+
+@app.route('/lam/sessions/<session_id>', methods=['POST'])
+def handle_session_lam(session_id):
+    """
+    LAM of the window data['x'], data['y'], data['w'] from the kept forward passes, answered like a 'lam' request.
+    """
+    data = request.get_json()
+    session = session_manager.get(session_id)
+    if session is None:
+        return jsonify({'error': f'Unknown session {session_id}'}), 404
+    if not session.is_current():
+        session_manager.close(session_id)
+        return jsonify({'error': f'Session {session_id} is out of date, its model or image changed'}), 409
+    model_key, img_path, _, data_range, sigma, fold, l, precision, model_options = session.key
+    opt_path, _, checkpoint_path, _ = model_key
+    model_file = checkpoint_path or opt_path
+    x, y, w = data.get('x'), data.get('y'), data.get('w')
+    try:
+        encoding = get_encoding(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    img_lr, img_hr, _ = load_img(img_path)
+    result_key = lam_result_key(model_file, img_path, y, x, w, data_range=data_range, sigma=sigma, fold=fold, l=l, precision=precision,
+                                model_options=model_options, **encoding)
+
+    def compute():
+        grad_numpy, result = session.compute_lam(y, x, w)
+        return grad_numpy, result, None
+
+    try:
+        zip_file = pack_lam(stream_lam_result(compute, img_lr, img_hr, result_key=result_key, alpha=0.5, **encoding))
+    except Exception:
+        return jsonify({'error': traceback.format_exc()}), 500
+    response = send_file(zip_file, mimetype='application/zip')
+    response.headers['X-LAM-Payload-Bytes'] = str(zip_file.getbuffer().nbytes)
+    return response
+
+@app.route('/lam/sessions/<session_id>', methods=['DELETE'])
+def close_session(session_id):
+    session = session_manager.close(session_id)
+    if session is None:
+        return jsonify({'error': f'Unknown session {session_id}'}), 404
+    return jsonify(session.to_dict())
+
+@app.route('/lam/stats', methods=['GET'])
+def handle_stats():
+    return jsonify({'models': model_cache.stats(), 'images': image_cache.stats(), 'paths': path_cache.stats(), 'results': result_store.stats(),
+                    'index': results_index.stats(), 'sessions': session_manager.stats()})
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    workers = int(os.environ.get('LAM_WORKERS', 0))
+    if workers > 0:
+        # LAM_WORKERS processes compute in parallel; let several jobs and requests reach them at once.
+        worker_pool = LAMWorkerPool(workers)
+        job_manager = JobManager(max_workers=workers, ttl=job_manager.ttl)
+        app.run(debug=False, threaded=True)
+    else:
+        app.run(debug=True)
\ No newline at end of file
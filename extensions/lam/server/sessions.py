@@ -0,0 +1,141 @@
+import os
+import time
+import hashlib
+import threading
+from cache import LRUCache
+from lam import lam_input, cached_blur_path, saliency_map, attr_grad, device
+from SaliencyModel.BackProp import attribution_objective, retain_path_forward, retained_path_gradient
+
+
+class SessionTooLarge(Exception):
+    pass
+
+
+def file_mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except (OSError, TypeError):
+        return None
+
+
+class LAMSession:
+    """
+    The blur path forward passes of one (model, image) pair, kept with their graphs: the window only enters
+    the objective, so moving it costs the backward passes alone.
+    :param key: identity of the session, see SessionManager.make_key
+    """
+
+    def __init__(self, key, model, tensor_lr, data_range=1., batch_size=1, sigma=1.2, fold=50, l=9, precision=None,
+                 cancel_event=None):
+        self.key = key
+        self.id = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:32]
+        self.data_range = data_range
+        self.path_forward = retain_path_forward(lam_input(tensor_lr, data_range), model, cached_blur_path(sigma, fold, l),
+                                                batch_size=batch_size, cancel_event=cancel_event, device=device, precision=precision)
+        self.nbytes = self.path_forward.nbytes
+        self.created = self.last_used = time.time()
+
+    def compute_lam(self, h, w, window_size, cancel_event=None):
+        """
+        Same as lam.compute_lam without crop_rf, for the window at (h, w).
+        :return: grad_numpy, result
+        """
+        path_forward = self.path_forward
+        if path_forward is None:
+            raise KeyError(f'Session {self.id} was released')
+        self.last_used = time.time()
+        attr_objective = attribution_objective(attr_grad, h, w, window=window_size)
+        grad_numpy, result_numpy = retained_path_gradient(path_forward, attr_objective, cancel_event=cancel_event)
+        if self.data_range != 1.:
+            result_numpy = [result / 2 + 0.5 for result in result_numpy]
+        return saliency_map(grad_numpy, result_numpy)
+
+    def is_current(self):
+        """
+        Whether the option file, checkpoint and image of the session are unchanged since it was opened.
+        """
+        model_key, img_path, img_mtime = self.key[:3]
+        opt_path, opt_mtime, checkpoint_path, checkpoint_mtime = model_key
+        return (file_mtime(opt_path), file_mtime(checkpoint_path), file_mtime(img_path)) == (opt_mtime, checkpoint_mtime, img_mtime)
+
+    def release(self):
+        # Windows being computed keep their own reference to the graphs until they finish.
+        self.path_forward = None
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'bytes': self.nbytes,
+            'created': self.created,
+            'last_used': self.last_used,
+        }
+
+
+class SessionManager:
+    """
+    LAM sessions bounded by the bytes their graphs hold and released ttl seconds after their last use.
+    :param capacity: maximum bytes of retained graphs, least recently used sessions are released first
+    :param ttl: seconds a session is kept without use
+    """
+
+    def __init__(self, capacity, ttl=300):
+        self.sessions = LRUCache(capacity, sizeof=lambda session: session.nbytes, on_evict=lambda key, session: session.release())
+        self.ttl = ttl
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_key, img_path, data_range=1., sigma=1.2, fold=50, l=9, precision=None, model_options=None):
+        """
+        :param model_key: model_loader.get_model_key of the model, with the mtimes of its files
+        """
+        return model_key, img_path, file_mtime(img_path), data_range, sigma, fold, l, precision, model_options
+
+    def open(self, key, factory):
+        """
+        Session of key, built with factory(key) unless it is kept already.
+        Raises SessionTooLarge when its graphs alone exceed the capacity.
+        """
+        def build():
+            session = factory(key)
+            if session.nbytes > self.sessions.capacity:
+                session.release()
+                raise SessionTooLarge(f'Session needs {session.nbytes} bytes, the capacity is {self.sessions.capacity}')
+            return session
+
+        self.prune()
+        session = self.sessions.get_or_create(key, build)
+        session.last_used = time.time()
+        with self.lock:
+            self.ids[session.id] = key
+        return session
+
+    def get(self, session_id):
+        self.prune()
+        with self.lock:
+            key = self.ids.get(session_id)
+        return self.sessions.get(key) if key is not None else None
+
+    def close(self, session_id):
+        with self.lock:
+            key = self.ids.pop(session_id, None)
+        session = self.sessions.pop(key) if key is not None else None
+        if session is not None:
+            session.release()
+        return session
+
+    def prune(self):
+        now = time.time()
+        with self.sessions.lock:
+            expired = [key for key, (session, _) in self.sessions.entries.items() if now - session.last_used > self.ttl]
+        for key in expired:
+            session = self.sessions.pop(key)
+            if session is not None:
+                session.release()
+        with self.lock:
+            self.ids = {session_id: key for session_id, key in self.ids.items() if key in self.sessions}
+
+    def stats(self):
+        stats = self.sessions.stats()
+        stats['ttl'] = self.ttl
+        return stats
@@ -0,0 +1,45 @@
+import os
+import sys
+import numpy as np
+import pytest
+from scipy import stats
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from SaliencyModel.utils import grid_kde, saliency_kde
+
+
+def scipy_kde(weights):
+    height, width = weights.shape
+    Y, X = np.mgrid[0:height:1, 0:width:1]
+    positions = np.vstack([X.ravel(), Y.ravel()])
+    kernel = stats.gaussian_kde(positions, weights=weights.ravel())
+    Z = np.reshape(kernel(positions).T, weights.shape)
+    return Z / Z.max()
+
+
+def peaked(rng):
+    weights = np.zeros((24, 32))
+    weights[10, 14] = 1.
+    weights[11, 15] = 0.5
+    return weights + 1e-3 * rng.random(weights.shape)
+
+
+def noisy(rng):
+    return rng.random((20, 28))
+
+
+def correlated(rng):
+    Y, X = np.mgrid[0:24:1, 0:30:1]
+    # mass along a diagonal band, so the bandwidth has an off-diagonal term
+    return np.exp(-0.5 * ((X - Y - 3) / 2.) ** 2) * rng.random((24, 30))
+
+
+@pytest.mark.parametrize('make_map', [peaked, noisy, correlated])
+def test_grid_kde_matches_scipy(make_map):
+    weights = make_map(np.random.default_rng(0))
+    weights = weights / weights.max()
+    np.testing.assert_allclose(saliency_kde(weights), scipy_kde(weights), rtol=0, atol=1e-5)
+
+
+def test_grid_kde_of_zero_map():
+    assert not grid_kde(np.zeros((8, 8))).any()
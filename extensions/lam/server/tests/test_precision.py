@@ -0,0 +1,52 @@
+import os
+import sys
+import numpy as np
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from SaliencyModel.attributes import attr_grad
+from SaliencyModel.BackProp import GaussianBlurPath, Path_gradient, attribution_objective
+
+
+class TinySR(torch.nn.Module):
+    """
+    x4 nearest upsampling plus a small residual with channel attention, like RCAN: the global pooling spreads
+    a NaN gradient anywhere in the window to every input pixel.
+    """
+
+    def __init__(self, residual_scale=1e-2):
+        super().__init__()
+        torch.manual_seed(0)
+        self.upsample = torch.nn.Conv2d(3, 48, 1, bias=False)
+        with torch.no_grad():
+            self.upsample.weight.zero_()
+            for channel in range(48):
+                self.upsample.weight[channel, channel // 16] = 1
+        self.head = torch.nn.Sequential(torch.nn.Conv2d(3, 16, 3, 1, 1), torch.nn.ReLU())
+        self.attention = torch.nn.Sequential(torch.nn.AdaptiveAvgPool2d(1), torch.nn.Conv2d(16, 16, 1), torch.nn.Sigmoid())
+        self.tail = torch.nn.Conv2d(16, 48, 3, 1, 1)
+        self.residual_scale = residual_scale
+        self.shuffle = torch.nn.PixelShuffle(4)
+
+    def forward(self, x):
+        feature = self.head(x)
+        return self.shuffle(self.upsample(x) + self.residual_scale * self.tail(feature * self.attention(feature)))
+
+
+def half_flat_image():
+    # The window straddles a flat half, where bf16 rounds neighbouring SR pixels to the same value
+    rng = np.random.default_rng(0)
+    image = np.zeros((3, 32, 32), dtype=np.float32)
+    image[:, :, 16:] = rng.random((3, 32, 16)) * 2 - 1
+    return image
+
+
+@pytest.mark.parametrize('w', [56, 100])
+def test_bf16_attribution_matches_float32(w):
+    attr_objective = attribution_objective(attr_grad, 48, w, window=16)
+    reference, reduced = [Path_gradient(half_flat_image(), TinySR(), attr_objective, GaussianBlurPath(1.2, 10, 9), precision=precision,
+                                        lean=True)[0][0] for precision in (None, 'bf16')]
+    assert np.all(np.isfinite(reduced))
+    assert np.any(reduced)
+    assert np.linalg.norm(reduced - reference) / np.linalg.norm(reference) < 0.05
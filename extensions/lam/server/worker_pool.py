@@ -0,0 +1,111 @@
+import os
+import time
+import multiprocessing as mp
+import numpy as np
+import torch
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from lam import load_img, compute_lam, pack_lam, stream_lam_result, check_encoding
+from model_loader import get_bare_model
+from SaliencyModel.BackProp import PathGradientCancelled
+
+
+def share_array(array):
+    """
+    Copy array into a new shared memory block owned by the receiver.
+    :return: (name, shape, dtype) handle for take_array
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    shm.close()
+    return shm.name, array.shape, array.dtype.str
+
+
+def take_array(handle):
+    name, shape, dtype = handle
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+def init_worker(num_threads):
+    torch.set_num_threads(num_threads)
+
+
+def compute_in_worker(path, img_path, h, w, window_size, cancel_event=None, **kwargs):
+    """
+    Load the model and image through this worker's caches and run compute_lam.
+    :return: shared memory handles of grad_numpy and result, compute_lam report
+    """
+    img_lr, img_hr, tensor_lr = load_img(img_path)
+    report = {}
+    grad_numpy, result = compute_lam(get_bare_model(path), tensor_lr, h, w, window_size, cancel_event=cancel_event, report=report, **kwargs)
+    return share_array(np.ascontiguousarray(grad_numpy)), share_array(np.ascontiguousarray(result)), report
+
+
+class LAMWorkerPool:
+    """
+    Pre-started worker processes running compute_lam, each with its own model and image caches.
+    Rendering and the result store stay in the server process.
+    :param workers: number of worker processes
+    :param num_threads: torch intra-op threads per worker, splits the CPU cores evenly when None
+    """
+
+    def __init__(self, workers, num_threads=None):
+        context = mp.get_context('spawn')
+        num_threads = num_threads or max(1, (os.cpu_count() or 1) // workers)
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=init_worker, initargs=(num_threads,))
+        self.manager = context.Manager()
+        # Start every worker now rather than on first use.
+        for future in [self.executor.submit(time.sleep, 0) for _ in range(workers)]:
+            future.result()
+
+    def compute_lam(self, path, img_path, h, w, window_size, cancel_event=None, report=None, **kwargs):
+        """
+        compute_lam for the model at path on a worker, forwarding cancel_event to it.
+        :param report: dict updated with the compute_lam report of the worker
+        :return: grad_numpy, result
+        """
+        remote_cancel_event = self.manager.Event()
+        future = self.executor.submit(compute_in_worker, path, img_path, h, w, window_size, cancel_event=remote_cancel_event, **kwargs)
+        while True:
+            try:
+                grad_handle, result_handle, worker_report = future.result(timeout=0.1)
+                break
+            except TimeoutError:
+                if cancel_event is not None and cancel_event.is_set():
+                    remote_cancel_event.set()
+                    if future.cancel():
+                        raise PathGradientCancelled()
+        if report is not None:
+            report.update(worker_report)
+        return take_array(grad_handle), take_array(result_handle)
+
+    def cal_lam(self, path, img_lr, img_hr, img_path, h, w, window_size, result_key=None, alpha=0.5, fmt='png', compression=None,
+                raw_dtype='float16', **kwargs):
+        """
+        Same as lam.cal_lam, with the model at path evaluated on a worker.
+        """
+        return pack_lam(self.stream_lam(path, img_lr, img_hr, img_path, h, w, window_size, result_key=result_key, alpha=alpha, fmt=fmt,
+                                        compression=compression, raw_dtype=raw_dtype, **kwargs))
+
+    def stream_lam(self, path, img_lr, img_hr, img_path, h, w, window_size, result_key=None, alpha=0.5, fmt='png', compression=None,
+                   raw_dtype='float16', **kwargs):
+        """
+        Same as lam.stream_lam, with the model at path evaluated on a worker.
+        """
+        check_encoding(fmt, compression, raw_dtype)
+        def compute():
+            report = {}
+            grad_numpy, result = self.compute_lam(path, img_path, h, w, window_size, report=report, **kwargs)
+            return grad_numpy, result, {'precisionCheck': report} if report else None
+
+        return stream_lam_result(compute, img_lr, img_hr, result_key=result_key, alpha=alpha, fmt=fmt, compression=compression,
+                                 raw_dtype=raw_dtype)
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.manager.shutdown()